@@ -43,6 +43,8 @@ class RIO(object):
                     [ 3, 2, 2, 1, 0,-1,-2,-3,-3,-4,-5,-5],\
                     [ 3, 2, 1, 0,-1,-2,-2,-3,-4,-4,-5,-6],\
                     [ 3, 1, 0,-1,-2,-2,-3,-3,-4,-5,-6,-6]]
+        # integer lookup table [iceClass,iceType] for array operations
+        self.RVtable = np.array(self.RVs,dtype=np.int8)
 
     def getRV(self,iceClass,iceType=None,iceThickness=0.0):
         """ Give ship ice class and ice type or ice thickness,
@@ -60,6 +62,68 @@ class RIO(object):
         it = np.where(self.hi_max>=iceThickness)[0][0] + 1
         return self.iceType[it]
 
+    def getIceClassIndex(self,iceClass):
+        """ Index of one ship ice class in RVtable.
+        """
+        return self.iceClass.index(iceClass)
+
+    def getIceTypeIndexfromIceThickness(self,iceThickness):
+        """ Vectorised getIceTypefromIceThickness returning iceType
+            indices of RVtable for an array of ice thicknesses in metres.
+        """
+        hi = np.asarray(iceThickness)
+        it = np.searchsorted(self.hi_max,hi,side='left') + 1
+        return np.minimum(it,len(self.iceType)-1)
+
+    def getRIO(self,iceClasses,siconcat,sithicat,catAxis=0):
+        """ Risk Index Outcome fields from multi-category ice fields,
+            e.g. LIM3 siconcat [0-1] and sithicat [m] with categories along
+            catAxis. Open water (1-sum(siconcat)) is weighted by the
+            'Ice Free' Risk Value. Concentrations are in tenths as in POLARIS.
+            iceClasses is one ship ice class or a list of them, the output
+            has a leading ice class axis in the latter case.
+            Masked input values give masked RIO.
+        """
+        single = isinstance(iceClasses,basestring)
+        if single:
+            iceClasses = [iceClasses]
+        ics = np.array([self.getIceClassIndex(ic) for ic in iceClasses])
+        conc = np.ma.asarray(siconcat,dtype=np.float64)
+        hi = np.ma.asarray(sithicat,dtype=np.float64)
+        conc = np.rollaxis(conc,catAxis)
+        hi = np.rollaxis(hi,catAxis)
+        mask = np.ma.getmaskarray(conc).any(axis=0) | \
+               np.ma.getmaskarray(hi).any(axis=0)
+        conc = conc.filled(0.)
+        its = self.getIceTypeIndexfromIceThickness(hi.filled(0.))
+        openw = np.clip(1. - conc.sum(axis=0),0.,1.)
+        out = np.empty((len(ics),)+mask.shape)
+        for k, ic in enumerate(ics):
+            rvs = self.RVtable[ic]
+            out[k] = 10.*(np.sum(conc*rvs[its],axis=0) + openw*rvs[0])
+        out = np.ma.masked_where(np.broadcast_to(mask,out.shape),out)
+        if single:
+            return out[0]
+        return out
+
+def benchRIO(n=200000,iceClass='PC6'):
+    """ Compare scalar getRV loop against getRIO on n random
+        ice thicknesses with full ice cover.
+    """
+    from time import time
+    rio = RIO()
+    hi = np.random.uniform(0.,4.,n)
+    t0 = time()
+    rvs = np.array([rio.getRV(iceClass,iceThickness=h) for h in hi])
+    ts = time()-t0
+    t0 = time()
+    rvv = rio.getRIO(iceClass,np.ones((1,n)),hi[np.newaxis])
+    tv = time()-t0
+    assert np.all(rvv==10*rvs)
+    print "n=%d scalar %6.3f s, vectorised %6.3f s, speedup %5.0f" % \
+          (n,ts,tv,ts/max(tv,1.e-9))
+
 if __name__=="__main__":
     rio = RIO()
-    rv  = rio.getRVfromIceType('Not ice strengthened','Ice Free')
+    rv  = rio.getRV('Not ice strengthened','Ice Free')
+    benchRIO()
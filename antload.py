@@ -9,13 +9,19 @@ import os
 import sys
 import gzip
 import cPickle
-from datetime import datetime, timedelta
 import numpy as np
 from scipy.io import loadmat
 import scipy.io.netcdf as nc
 import glob
+from time import time as walltime
+from gridindex import getGridIndex
+from region import Region
+from instrument import NULL, getInstrument
 sys.path.append(os.path.join(os.getenv('HOME'),'python/GeoInterpolate/'))
-from GeoInterpolate_f90r import geointerpolate_f90r as gi
+try:
+    from GeoInterpolate_f90r import geointerpolate_f90r as gi
+except ImportError:
+    gi = None # only needed for nnEngine='fortran'
 
 # global functions
 def save_zipped_pickle(obj, filename, protocol=-1):
@@ -27,15 +33,165 @@ def load_zipped_pickle(filename):
         loaded_object = cPickle.load(f)
         return loaded_object
 
+# columns of the segment files: (Antload attribute, netCDF type, units)
+SEGMENT_COLUMNS = [('data','f4','m'),\
+                   ('lat','f8','degrees_north'),\
+                   ('lon','f8','degrees_east'),\
+                   ('time','i8','seconds since 1970-01-01 00:00:00'),\
+                   ('x','i4','1'),\
+                   ('y','i4','1')]
+
+def save_segments(obj, filename, instr=NULL):
+    """ Write segment data of an Antload object as typed columns
+        to a netCDF4 file, one variable per column.
+    """
+    import netCDF4
+    with instr.timer('save_segments'):
+        fp = netCDF4.Dataset(filename,'w',format='NETCDF4')
+        fp.createDimension('segment',len(obj.data))
+        for vname, vtype, units in SEGMENT_COLUMNS:
+            if vname=='time':
+                vals = np.array(obj.dates,dtype='datetime64[s]').astype(np.int64)
+            else:
+                vals = np.asarray(getattr(obj,vname))
+            outVar = fp.createVariable(vname,vtype,('segment',),contiguous=True)
+            outVar[:] = vals
+            outVar.units = units
+        for attr in ['grdfile','gx','gy']:
+            if hasattr(obj,attr):
+                setattr(fp,attr,getattr(obj,attr))
+        fp.close()
+    instr.count('segments.written',len(obj.data))
+    instr.count('bytes.written',os.path.getsize(filename))
+
+def load_segments(filename, columns=None, instr=NULL):
+    """ Read columns (default all) of a segment file to an Antload object,
+        'time' gives also dates as a datetime64[s] array.
+    """
+    import netCDF4
+    obj = Antload()
+    if columns is None:
+        columns = [c[0] for c in SEGMENT_COLUMNS]
+    with instr.timer('load_segments'):
+        fp = netCDF4.Dataset(filename)
+        for vname in columns:
+            vals = fp.variables[vname][:]
+            vals = np.ma.getdata(vals)
+            setattr(obj,vname,vals)
+            if vname=='time':
+                obj.dates = vals.astype('datetime64[s]')
+        for attr in fp.ncattrs():
+            setattr(obj,attr,getattr(fp,attr))
+        fp.close()
+    instr.count('bytes.read',sum([getattr(obj,c).nbytes for c in columns]))
+    return obj
+
+def convert_pickle(cgzfile):
+    """ Convert antloadNN.cpickle.gz to antloadNN.nc segment file
+    """
+    fout = cgzfile.replace('.cpickle.gz','.nc')
+    save_segments(load_zipped_pickle(cgzfile),fout)
+    return fout
+
+# mat file variables used by Antload
+RAWVARS = ['Hice2','Latitude','Longitude','Timestamp','Lamp']
+PROVARS = ['selectgoodth','selectrammings','segments100m']
+
+def openMatFile(fn, variable_names):
+    """ Only the variables variable_names of a mat file,
+        v7.3 (HDF5) files are opened with h5py and read lazily.
+    """
+    try:
+        return loadmat(fn,variable_names=variable_names)
+    except NotImplementedError:
+        import h5py
+        fp = h5py.File(fn,'r')
+        return dict([(v,fp[v]) for v in variable_names])
+
+def closeMatFile(mat):
+    """ Close the h5py file of a mat file opened by openMatFile
+    """
+    for var in mat.values():
+        if hasattr(var,'file') and var.file:
+            var.file.close()
+            break
+
+def matVector(var, i0=0, i1=None):
+    """ Elements i0:i1 of a mat file vector as a 1-D array
+    """
+    if var.shape[0]==1 and len(var.shape)==2:
+        return np.asarray(var[0,i0:i1])
+    return np.asarray(var[i0:i1]).ravel()
+
+def matMatrix(var):
+    """ A whole mat file matrix, h5py datasets are stored transposed
+    """
+    if isinstance(var,np.ndarray):
+        return var
+    return np.asarray(var[:]).T
+
+def reduceSegments(vals,valid,bounds,reducer='mean'):
+    """ Reduce variables vals (nvar,n) over valid (n,) samples
+        in segments bounds (nseg,2) as [start,end) indices, all variables
+        in one pass. reducer is 'mean', 'median' or 'count'.
+        Return reduced values (nvar,nseg) and valid counts (nseg,),
+        values of segments without valid samples are undefined.
+    """
+    vals = np.atleast_2d(np.asarray(vals,dtype=np.float64))
+    nvar, n = vals.shape
+    valid = np.asarray(valid,dtype=bool).ravel()
+    bounds = np.clip(np.asarray(bounds).astype(np.int64),0,n)
+    start, end = bounds[:,0], np.maximum(bounds[:,1],bounds[:,0])
+    cvalid = np.concatenate(([0],np.cumsum(valid,dtype=np.int64)))
+    cnt = cvalid[end]-cvalid[start]
+    if reducer=='count':
+        return cnt[np.newaxis].astype(np.float64), cnt
+    if reducer=='mean':
+        # pad so that end==n is a valid reduceat index, odd
+        # elements of reduceat are the gaps between segments
+        w = np.zeros((nvar,n+1))
+        w[:,:n] = np.where(valid,vals,0.)
+        idx = np.column_stack((start,end)).ravel()
+        sums = np.add.reduceat(w,idx,axis=1)[:,::2]
+        return sums/np.maximum(cnt,1), cnt
+    if reducer=='median':
+        # gather sample indices of each segment, overlaps allowed
+        lens = end-start
+        segid = np.repeat(np.arange(len(lens)),lens)
+        pos = np.arange(lens.sum()) - np.repeat(np.cumsum(lens)-lens,lens) + \
+              np.repeat(start,lens)
+        ok = valid[pos]
+        segid, pos = segid[ok], pos[ok]
+        off = np.cumsum(cnt)-cnt
+        lo = off + np.maximum(cnt-1,0)//2
+        hi = off + cnt//2
+        out = np.zeros((nvar,len(cnt)))
+        if len(pos)==0:
+            return out, cnt
+        lo, hi = np.minimum(lo,len(pos)-1), np.minimum(hi,len(pos)-1)
+        for k in range(nvar):
+            v = vals[k,pos]
+            v = v[np.lexsort((v,segid))]
+            out[k] = (v[lo]+v[hi])/2.
+        return out, cnt
+    raise ValueError("Unknown reducer %s" % reducer)
+
+class NoValidSegments(Exception):
+    pass
+
 class Antload(object):
-    def __init__(self):
+    instr = NULL # timers and counters, see instrument.py
+
+    def __init__(self,nnEngine='kdtree',instr=NULL):
         self.data  = []
-        self.dates = []
+        self.dates = np.zeros(0,dtype='datetime64[s]') # UTC
         self.lat   = []
         self.lon   = []
         self.x     = [] # closest model grid index (ix,iy)
         self.y     = [] # closest model grid index (ix,iy)
         self.vname = 'sit' # sea ice thickness
+        self.nnEngine = nnEngine # 'kdtree' or 'fortran' grid lookup
+        self.instr = instr
 
     def selectData(self,vname,raw,pro):
         """ Select valid values by masking out invalid ones
@@ -52,53 +208,248 @@ class Antload(object):
                                             for i in range(pro[segkey].shape[0])])
         return out[np.where(out.mask==False)]
 
-    def readMatFile(self,fidx):
-        date0 = datetime(1970,1,1,0) # UTC
-        raw  = loadmat("mittaus%02d.mat" % fidx)
-        pro  = loadmat("processed%d.mat" % fidx)
-        hice2 = self.selectData('Hice2',raw,pro)
-        lat = self.selectData('Latitude',raw,pro)
-        lon = self.selectData('Longitude',raw,pro)
-        timestamp = self.selectData('Timestamp',raw,pro)
-        # average valid data in 100m segments
-        self.data = self.getSegment(hice2,pro)
+    def validMask(self,raw,pro,vnames=[]):
+        """ Boolean array of valid samples, the complement of the
+            selectData mask, also excluding non-finite values of vnames.
+        """
+        valid = ~((pro['selectgoodth']==0)|\
+                  (pro['selectrammings']==1)|\
+                  (raw['Lamp']<=1170)|\
+                  (raw['Hice2']<0)).ravel()
+        for vname in vnames:
+            valid &= np.isfinite(raw[vname].ravel())
+        return valid
+
+    def getSegments(self,vnames,raw,pro,reducer='mean',segkey='segments100m',\
+                    chunksize=None):
+        """ Reduce raw variables vnames in segments in one pass.
+            Return a dict of arrays of the segments having valid data,
+            the number of valid samples of these segments is under 'count'.
+            With chunksize, raw data are processed in chunks of whole
+            segments of about chunksize samples, so that only the chunks
+            are copied and masked, or read for lazily opened v7.3 files.
+        """
+        bounds = matMatrix(pro[segkey]).astype(np.int64)
+        if bounds.size==0:
+            raise NoValidSegments("No %s segments!" % segkey)
+        chunks = [0,len(bounds)]
+        if chunksize is not None and np.all(np.diff(bounds[:,0])>=0):
+            chunks = np.searchsorted(bounds[:,0],np.arange(bounds[0,0],\
+                                     bounds[-1,0]+1,chunksize))
+            chunks = np.unique(np.hstack((chunks,len(bounds))))
+        outs, cnts = [], []
+        rvars = set(vnames+['Lamp','Hice2'])
+        pvars = ['selectgoodth','selectrammings']
+        for k0, k1 in zip(chunks[:-1],chunks[1:]):
+            if k1==k0:
+                continue
+            i0, i1 = bounds[k0:k1,0].min(), bounds[k0:k1,1].max()
+            with self.instr.timer('readchunk'):
+                rawc = dict([(v,matVector(raw[v],i0,i1)) for v in rvars])
+                proc = dict([(v,matVector(pro[v],i0,i1)) for v in pvars])
+            with self.instr.timer('mask'):
+                valid = self.validMask(rawc,proc,vnames)
+            with self.instr.timer('reduce'):
+                vals = np.vstack([rawc[vname] for vname in vnames])
+                out, cnt = reduceSegments(vals,valid,bounds[k0:k1]-i0,\
+                                          reducer=reducer)
+            self.instr.count('samples.read',i1-i0)
+            self.instr.count('samples.masked',len(valid)-valid.sum())
+            outs.append(out)
+            cnts.append(cnt)
+        out = np.hstack(outs) if outs else np.zeros((len(vnames),0))
+        cnt = np.hstack(cnts) if cnts else np.zeros(0,dtype=np.int64)
+        iseg = np.where(cnt>0)[0]
+        segs = dict([(vname,out[k,iseg]) for k,vname in enumerate(vnames)])
+        segs['count'] = cnt[iseg]
+        self.instr.count('segments.read',len(cnt))
+        self.instr.count('segments.valid',len(iseg))
+        return segs
+
+    def readMatFile(self,fidx,chunksize=2**20):
+        """ Read only the variables needed and average them in
+            100m segments, chunksize samples at a time.
+        """
+        fns = ["mittaus%02d.mat" % fidx, "processed%d.mat" % fidx]
+        raw, pro = {}, {}
+        try:
+            with self.instr.timer('loadmat'):
+                raw  = openMatFile(fns[0],RAWVARS)
+                pro  = openMatFile(fns[1],PROVARS)
+            self.instr.count('bytes.read',\
+                             sum([os.path.getsize(fn) for fn in fns]))
+            # average valid data in 100m segments
+            segs = self.getSegments(['Hice2','Latitude','Longitude',\
+                                     'Timestamp'],raw,pro,chunksize=chunksize)
+        finally:
+            closeMatFile(raw)
+            closeMatFile(pro)
+        self.data = segs['Hice2']
         if len(self.data)==0:
-            print "No valid segments!"
-            sys.exit(0)
-        self.lat = self.getSegment(lat,pro)
-        self.lon = self.getSegment(lon,pro)
-        time = self.getSegment(timestamp,pro)
-        self.dates = [date0 + timedelta(t/86400,t%86400) for t in time]
-        min_i = gi.nearest_neighbour_indices(self.lon,self.lat,\
-                                       self.grdlon,self.grdlat,\
-                                               self.gx,self.gy,\
-                                                  len(self.lon))
-        self.x, self.y = min_i[:,0]-1, min_i[:,1]-1
+            raise NoValidSegments("No valid segments in file %d!" % fidx)
+        self.lat = segs['Latitude']
+        self.lon = segs['Longitude']
+        time = segs['Timestamp']
+        # Timestamp is in seconds since 1970-01-01 UTC
+        self.dates = np.round(time).astype(np.int64).astype('datetime64[s]')
+        with self.instr.timer('gridlookup'):
+            self.x, self.y = self.nearestGridIndices(self.lon,self.lat)
+
+    def nearestGridIndices(self,lon,lat):
+        """ 0-based global indices (x,y) of the closest model grid points
+        """
+        if self.nnEngine=='fortran':
+            min_i = gi.nearest_neighbour_indices(lon,lat,\
+                                           self.grdlon,self.grdlat,\
+                                                   self.gx,self.gy,\
+                                                          len(lon))
+            return self.region.toGlobal(min_i[:,0]-1,min_i[:,1]-1)
+        return self.gridIndex.query(lon,lat)
 
     def readModelGrid(self,lat_lim=-55.,\
-                      grdfile="coordinates_ORCA025.nc"):
-        fp = nc.netcdf_file(grdfile)
-        lat = np.array(fp.variables['nav_lat'][:])
-        idx = np.where(lat<-55.)
-        lon = np.array(fp.variables['nav_lon'][:])
-        self.grdlat = lat[:idx[0].max()+1,:]
-        self.grdlon = lon[:idx[0].max()+1,:]
-        fp.close()
+                      grdfile="coordinates_ORCA025.nc",region=None):
+        """ Read model grid rows up to the last one with latitudes south
+            of lat_lim, cropped to a Region if given. Grid indices are
+            looked up in the whole subdomain so they stay global.
+        """
+        with self.instr.timer('readgrid'):
+            fp = nc.netcdf_file(grdfile)
+            lat = np.array(fp.variables['nav_lat'][:])
+            idx = np.where(lat<lat_lim)
+            lon = np.array(fp.variables['nav_lon'][:])
+            self.grdlat = lat[:idx[0].max()+1,:]
+            self.grdlon = lon[:idx[0].max()+1,:]
+            fp.close()
+        self.grdfile = grdfile
         self.gx, self.gy = self.grdlon.shape
+        self.region = Region.full(self.grdlon.shape)
+        if self.nnEngine=='kdtree':
+            with self.instr.timer('gridindex'):
+                self.gridIndex = getGridIndex(self.grdlon,self.grdlat,grdfile)
+        if region is not None:
+            self.cropModelGrid(region)
 
-if __name__ == "__main__":
-    fidx = int(sys.argv[1])
-    cgzfile = "antload%02d.cpickle.gz" % fidx
-    antload = Antload()
-    antload.readModelGrid()
-    if not os.path.exists(cgzfile):
-        sys.stdout.write("Starting %02d ...\n" % fidx)
-        sys.stdout.flush()
+    def cropModelGrid(self,region):
+        """ Keep only the Region region of the model grid
+        """
+        sl = region.within(self.region)
+        self.grdlat = self.grdlat[sl]
+        self.grdlon = self.grdlon[sl]
+        self.gx, self.gy = self.grdlon.shape
+        self.region = region
+
+    def copyModelGrid(self,other):
+        """ Share the model grid read by another Antload object
+        """
+        self.grdlat, self.grdlon = other.grdlat, other.grdlon
+        self.grdfile = other.grdfile
+        self.gx, self.gy = other.gx, other.gy
+        self.region = other.region
+        if hasattr(other,'gridIndex'):
+            self.gridIndex = other.gridIndex
+
+# model grid of the batch, set before the process pool is created
+# so that forked workers inherit it read-only
+_grid = None
+
+def outputFile(fidx):
+    return "antload%02d.nc" % fidx
+
+def isUpToDate(fidx):
+    """ Output exists and is newer than both input mat files
+    """
+    fout = outputFile(fidx)
+    if not os.path.exists(fout):
+        return False
+    fins = ["mittaus%02d.mat" % fidx, "processed%d.mat" % fidx]
+    tin = max([os.path.getmtime(f) for f in fins if os.path.exists(f)]+[0])
+    return os.path.getmtime(fout)>=tin
+
+def processFile(fidx,force=False,stats=False,profile=[]):
+    """ Process one campaign file with the shared model grid.
+        Return (fidx,status,seconds,summary), errors are reported in
+        status, summary of timers and counters is None without stats.
+        Profiled stages are written to antloadNN.nc.<stage>.prof.
+    """
+    t0 = walltime()
+    if not force and isUpToDate(fidx):
+        return fidx, 'up to date', walltime()-t0, None
+    instr = getInstrument(stats,profile)
+    antload = Antload(instr=instr)
+    antload.copyModelGrid(_grid)
+    try:
         antload.readMatFile(fidx)
-        # save
-        save_zipped_pickle(antload,cgzfile)
-    # load
-    antload = load_zipped_pickle(cgzfile)
-    sys.stdout.write("%s processed!\n" % fidx)
-    sys.stdout.flush()
+        save_segments(antload,outputFile(fidx),instr)
+        status = 'processed'
+    except NoValidSegments, e:
+        status = str(e)
+    except Exception, e:
+        status = "failed: %s" % repr(e)
+    instr.writeProfiles(outputFile(fidx))
+    return fidx, status, walltime()-t0, instr.summary()
+
+def processFiles(fidxs,nproc=None,force=False,instr=NULL,profile=[]):
+    """ Process campaign files fidxs in a process pool of nproc workers
+        reading and indexing the model grid only once. Timers and
+        counters of the workers are added to instr.
+    """
+    global _grid
+    _grid = Antload(instr=instr)
+    # reads also the grid index, before forking
+    _grid.readModelGrid()
+    results = []
+    if nproc==1 or len(fidxs)==1:
+        for fidx in fidxs:
+            results.append(processFile(fidx,force,instr.enabled,profile))
+            instr.merge(results[-1][3])
+            sys.stdout.write("%02d %s in %.1f s\n" % results[-1][:3])
+            sys.stdout.flush()
+        return results
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        futures = [pool.submit(processFile,fidx,force,instr.enabled,profile) \
+                   for fidx in fidxs]
+        for future in as_completed(futures):
+            results.append(future.result())
+            instr.merge(results[-1][3])
+            sys.stdout.write("%02d %s in %.1f s\n" % results[-1][:3])
+            sys.stdout.flush()
+    return sorted(results)
+
+def parseIndices(args):
+    """ File indices from arguments like 3 or 1-20
+    """
+    fidxs = []
+    for arg in args:
+        if '-' in arg:
+            i0, i1 = [int(a) for a in arg.split('-')]
+            fidxs.extend(range(i0,i1+1))
+        else:
+            fidxs.append(int(arg))
+    return fidxs
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('fidx',nargs='*',help="file index or range, e.g. 3 or 1-20")
+    parser.add_argument('-j','--nproc',type=int,default=None,\
+                        help="number of worker processes")
+    parser.add_argument('-f','--force',action='store_true',\
+                        help="reprocess files that are up to date")
+    parser.add_argument('--convert',nargs='+',metavar='CPICKLE',\
+                        help="convert old antloadNN.cpickle.gz files")
+    parser.add_argument('--stats',default=None,metavar='FILE',\
+                        help="write timers and counters to a .json or .csv file")
+    parser.add_argument('--profile',nargs='+',default=[],metavar='STAGE',\
+                        help="profile stages, e.g. loadmat reduce gridlookup")
+    args = parser.parse_args()
+    instr = getInstrument(args.stats is not None)
+    for cgzfile in args.convert or []:
+        print "Converted %s to %s" % (cgzfile,convert_pickle(cgzfile))
+    if args.fidx:
+        processFiles(parseIndices(args.fidx),nproc=args.nproc,\
+                     force=args.force,instr=instr,profile=args.profile)
+    if args.stats is not None:
+        instr.report()
+        instr.write(args.stats)
     print "Finnished!"
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+Benchmark the EM-to-ORCA pipeline on synthetic stand-ins of the inputs:
+EM transects (mittausNN.mat, processedNN.mat), a curvilinear ORCA-like
+grid (coordinates_ORCA025.nc) and LIM3 category fields (icemod).
+Each stage runs in its own process and reports wall time, throughput
+and peak memory, for every combination of transect length and grid size.
+Results are written to a JSON file, --compare prints ratios against
+results of an earlier version.
+"""
+
+__author__ = "<petteri.uotila@fmi.fi>"
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import resource
+import Queue
+import subprocess
+import multiprocessing
+from time import time as walltime
+from datetime import datetime
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import netCDF4 as nc
+from scipy.io import savemat
+
+REPODIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,REPODIR)
+
+# synthetic data generators
+
+def makeGrid(fn,ny,nx,latmin=-80.,latmax=-30.):
+    """ Curvilinear ORCA-like grid with rows from south to north,
+        gently distorted so that rows are not of constant latitude
+    """
+    i = (np.arange(nx)+0.5)/nx
+    j = np.arange(ny)/float(ny-1)
+    lon = -180.+360.*i[np.newaxis,:] + 2.*np.sin(np.pi*j)[:,np.newaxis]
+    lat = latmin + (latmax-latmin)*j[:,np.newaxis] + \
+          0.5*np.sin(2*np.pi*i)[np.newaxis,:]*(1-j)[:,np.newaxis]
+    lon = (lon+180.)%360.-180.
+    fp = nc.Dataset(fn,'w',format='NETCDF3_CLASSIC')
+    fp.createDimension('y',ny)
+    fp.createDimension('x',nx)
+    for vname, vals, units in [('nav_lat',lat,'degrees_north'),\
+                               ('nav_lon',lon,'degrees_east')]:
+        outVar = fp.createVariable(vname,'f4',('y','x'))
+        outVar[:] = vals
+        outVar.units = units
+    fp.close()
+
+def makeTransect(fidx,nsamples,maskrate=0.2,segsize=20,seed=0,\
+                 lat0=-69.,lon0=-6.,t0=datetime(2013,12,20)):
+    """ mittausNN.mat and processedNN.mat of a ship track of nsamples
+        1 s samples, about maskrate of them invalid, segments of about
+        segsize samples
+    """
+    rng = np.random.RandomState(seed)
+    n = int(nsamples)
+    # ship moving about 5 m/s in slowly turning direction
+    heading = np.cumsum(rng.normal(0.,0.01,n))
+    lat = lat0 + np.cumsum(5.*np.cos(heading))/111.e3
+    lon = lon0 + np.cumsum(5.*np.sin(heading))/(111.e3*np.cos(np.radians(lat)))
+    epoch = (t0-datetime(1970,1,1)).total_seconds()
+    raw = {'Hice2':rng.lognormal(0.,0.6,n)-0.05,\
+           'Latitude':lat,\
+           'Longitude':lon,\
+           'Timestamp':epoch+np.arange(n,dtype=np.float64),\
+           'Lamp':np.where(rng.rand(n)<maskrate/2.,1000.,1500.),\
+           'Conductivity':rng.rand(n)} # a variable that is not needed
+    raw = dict([(k,v[:,np.newaxis]) for k,v in raw.items()])
+    ends = np.cumsum(rng.randint(segsize//2,3*segsize//2+1,n//segsize+1))
+    ends = np.hstack((ends[ends<n],[n]))
+    starts = np.hstack(([0],ends[:-1]))
+    pro = {'selectgoodth':(rng.rand(n,1)>=maskrate/2.)*1.,\
+           'selectrammings':(rng.rand(n,1)<0.01)*1.,\
+           'segments100m':np.column_stack((starts,ends)).astype(np.float64)}
+    savemat("mittaus%02d.mat" % fidx,raw)
+    savemat("processed%d.mat" % fidx,pro)
+
+def makeIcemod(fn,grdfile,nt=1,ncat=5,seed=0,t0=datetime(2013,12,1),\
+               step=86400):
+    """ LIM3 icemod file with category fields on the grid of grdfile,
+        nt records step seconds apart, the first centred at t0
+    """
+    rng = np.random.RandomState(seed)
+    fin = nc.Dataset(grdfile)
+    lat, lon = fin.variables['nav_lat'][:], fin.variables['nav_lon'][:]
+    fin.close()
+    ny, nx = lat.shape
+    fp = nc.Dataset(fn,'w')
+    fp.createDimension('time_counter',None)
+    fp.createDimension('ncatice',ncat)
+    fp.createDimension('y',ny)
+    fp.createDimension('x',nx)
+    for vname, vals in [('nav_lat',lat),('nav_lon',lon)]:
+        fp.createVariable(vname,'f4',('y','x'))[:] = vals
+    tvar = fp.createVariable('time_counter','f8',('time_counter',))
+    tvar.units = "seconds since 1900-01-01 00:00:00"
+    tvar[:] = (t0-datetime(1900,1,1)).total_seconds() + step*np.arange(nt)
+    hcat = np.array([0.3,0.8,1.6,2.9,4.5])[:ncat]
+    conc = rng.dirichlet(np.ones(ncat+1),(nt,ny,nx))[...,:ncat]
+    flds = {'siconcat':np.rollaxis(conc,3,1),\
+            'sithicat':hcat[np.newaxis,:,np.newaxis,np.newaxis]*\
+                       rng.uniform(0.8,1.2,(nt,ncat,ny,nx)),\
+            'snthicat':rng.uniform(0.,0.4,(nt,ncat,ny,nx))}
+    for vname, vals in flds.items():
+        outVar = fp.createVariable(vname,'f4',\
+                                   ('time_counter','ncatice','y','x'),\
+                                   fill_value=1.e20)
+        outVar[:] = np.ma.masked_where(np.broadcast_to(lat>-55.,vals.shape),\
+                                       vals)
+    fp.close()
+
+# stages, each returns the number of items processed
+
+def stageReadMatFile(fidx):
+    from antload import Antload, save_segments
+    antload = Antload()
+    antload.readModelGrid()
+    antload.readMatFile(fidx)
+    save_segments(antload,"antload%02d.nc" % fidx)
+    return len(antload.data)
+
+def stageGridIndex(nobs):
+    from antload import Antload
+    from gridindex import GridIndex
+    antload = Antload(nnEngine=None)
+    antload.readModelGrid()
+    ii = np.random.randint(0,antload.grdlon.size,nobs)
+    gidx = GridIndex(antload.grdlon,antload.grdlat)
+    gidx.query(antload.grdlon.ravel()[ii],antload.grdlat.ravel()[ii])
+    return nobs
+
+def stageSampleEM(fns):
+    from sampleEM2ORCA import sampleFiles
+    from antload import load_segments
+    sampleFiles(fns,corrections={})
+    return sum([len(load_segments(fn,['data']).data) for fn in fns])
+
+def stageEMSITD(fn):
+    from plotEMandLIMDistros import EMSITD
+    em = EMSITD(fn,tidx=None)
+    return em.cnt.size
+
+def stageLIM3SITD(fn):
+    from plotEMandLIMDistros import LIM3SITD
+    lim = LIM3SITD(fn,tidx=None)
+    return lim.siconcat[0,0].size
+
+def stageCollocate(segfns,modfns):
+    from collocate import collocate
+    out = collocate(segfns,modfns,freq='1d',corrections={})
+    return len(out['data'])
+
+def stageFieldTests(ny,nx,ncat=4):
+    from cellstats import fieldTests
+    rng = np.random.RandomState(0)
+    obs = np.ma.array(rng.rand(ncat,ny,nx))
+    mod = np.ma.array(rng.rand(ncat,ny,nx))
+    fieldTests(obs,mod)
+    return ny*nx
+
+def runStage(func,*args):
+    """ Run func(*args) in a child process, return wall time, items,
+        peak resident memory and its increase during the stage in MB
+        and an error or None. A child that dies without a result, e.g.
+        killed by the OOM killer, gives an error of its exit code.
+    """
+    queue = multiprocessing.Queue()
+    def target():
+        rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        t0 = walltime()
+        try:
+            nitems = func(*args)
+            err = None
+        except Exception, e:
+            nitems, err = 0, repr(e)
+        dt = walltime()-t0
+        rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put((dt,nitems,rss1/1024.,(rss1-rss0)/1024.,err))
+    proc = multiprocessing.Process(target=target)
+    t0 = walltime()
+    proc.start()
+    out = None
+    while out is None:
+        try:
+            out = queue.get(timeout=1.)
+        except Queue.Empty:
+            if proc.is_alive():
+                continue
+            # the result may have arrived just before the exit
+            try:
+                out = queue.get(timeout=1.)
+            except Queue.Empty:
+                out = (walltime()-t0,0,0.,0.,\
+                       "stage process died with exit code %s" % proc.exitcode)
+    proc.join()
+    return out
+
+def benchScenario(nsamples,ny,nx,maskrate=0.2):
+    """ All stages for one transect length and grid size
+    """
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp(prefix='emorca_bench_')
+    os.chdir(tmpdir)
+    try:
+        makeGrid('coordinates_ORCA025.nc',ny,nx)
+        makeTransect(1,nsamples,maskrate=maskrate)
+        makeIcemod('icemod.nc','coordinates_ORCA025.nc')
+        # daily records over the whole transect
+        ndays = int(nsamples)//86400+2
+        makeIcemod('icemod_1d.nc','coordinates_ORCA025.nc',nt=ndays,\
+                   t0=datetime(2013,12,20,12))
+        stages = [('readMatFile',stageReadMatFile,(1,),'segments'),\
+                  ('gridIndex',stageGridIndex,(100000,),'points'),\
+                  ('sampleEMThickness',stageSampleEM,(['antload01.nc'],),\
+                   'segments'),\
+                  ('EMSITD',stageEMSITD,('antload_1m_sitd.nc',),'cells'),\
+                  ('LIM3SITD',stageLIM3SITD,('icemod.nc',),'cells'),\
+                  ('collocate',stageCollocate,(['antload01.nc'],\
+                                               ['icemod_1d.nc']),'segments'),\
+                  ('fieldTests',stageFieldTests,(ny,nx),'cells')]
+        results = []
+        for name, func, args, unit in stages:
+            dt, nitems, peak, dpeak, err = runStage(func,*args)
+            rec = {'stage':name,'nsamples':int(nsamples),'ny':ny,'nx':nx,\
+                   'maskrate':maskrate,'seconds':dt,'items':int(nitems),\
+                   'unit':unit,'throughput':nitems/max(dt,1.e-9),\
+                   'peak_mb':peak,'stage_mb':dpeak}
+            if err is not None:
+                rec['error'] = err
+            results.append(rec)
+            print "%-18s n=%8d grid=%4dx%-5d %8.3f s %12.0f %s/s %8.1f MB%s" % \
+                  (name,nsamples,ny,nx,dt,rec['throughput'],unit,peak,\
+                   '' if err is None else ' '+err)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+    return results
+
+def version():
+    try:
+        return subprocess.check_output(['git','describe','--always','--dirty'],\
+                                       cwd=REPODIR).strip()
+    except Exception:
+        return 'unknown'
+
+def compare(new,old):
+    """ Print time ratios of stages found in both result sets
+    """
+    key = lambda r: (r['stage'],r['nsamples'],r['ny'],r['nx'])
+    olds = dict([(key(r),r) for r in old['results']])
+    print "Compared to %s:" % old['version']
+    for r in new['results']:
+        if key(r) in olds:
+            print "%-18s n=%8d grid=%4dx%-5d time x%6.2f memory x%6.2f" % \
+                  (key(r)+(r['seconds']/max(olds[key(r)]['seconds'],1.e-9),\
+                   r['peak_mb']/max(olds[key(r)]['peak_mb'],1.e-9)))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lengths',nargs='+',type=float,default=[1.e5,1.e6],\
+                        help="transect lengths in samples")
+    parser.add_argument('--grids',nargs='+',default=['200x360','400x1442'],\
+                        help="grid sizes NYxNX")
+    parser.add_argument('--maskrate',type=float,default=0.2)
+    parser.add_argument('-o','--output',default='bench_results.json')
+    parser.add_argument('--compare',default=None,\
+                        help="earlier results file to compare with")
+    args = parser.parse_args()
+    results = []
+    for grid in args.grids:
+        ny, nx = [int(n) for n in grid.split('x')]
+        for nsamples in args.lengths:
+            results += benchScenario(nsamples,ny,nx,args.maskrate)
+    out = {'version':version(),'date':datetime.today().isoformat(),\
+           'results':results}
+    with open(args.output,'w') as f:
+        json.dump(out,f,indent=1)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(out,json.load(f))
+    print "Finnished!"
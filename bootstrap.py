@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Bootstrap confidence intervals of observed ice thickness distributions.
+The category counts of every observed cell are resampled from the
+multinomial distribution of their own fractions, with a random stream
+of each grid cell. Percentile intervals are computed for the category
+fractions and for the mean thickness of the distribution as in
+PlotObsMods.plotSITD. Cells are processed in chunks small enough for
+a memory limit, optionally in a process pool.
+"""
+
+__author__ = "<petteri.uotila@fmi.fi>"
+
+import numpy as np
+import netCDF4 as nc
+
+def hicatMean(hiceb):
+    """ Category mid thicknesses of upper boundaries hiceb as in EMSITD
+    """
+    hicats = np.hstack(([0],hiceb[:-1],[5]))
+    return (hicats[1:]+hicats[:-1])/2
+
+def multinomialResample(cnt,frac,nboot,seed,cells):
+    """ nboot resamples (nboot,ncat,ncell) of cnt (ncell,) observations
+        from category fractions frac (ncat,ncell), drawn from the random
+        stream seed+[cell] of each cell in cells (ncell,)
+    """
+    ncat, ncell = frac.shape
+    out = np.zeros((nboot,ncat,ncell),dtype=np.int32)
+    for k in range(ncell):
+        rng = np.random.RandomState(list(seed)+[int(cells[k])])
+        out[:,:,k] = rng.multinomial(cnt[k],frac[:,k],nboot)
+    return out
+
+def _bootstrapChunk(args):
+    cnts, hmean, nboot, alpha, seed, cells = args
+    cnt = cnts.sum(axis=0)
+    frac = cnts/cnt.astype(float)
+    bfrac = multinomialResample(cnt,frac,nboot,seed,cells)/cnt.astype(float)
+    # mean thickness without the last category as in plotSITD
+    bmean = np.tensordot(hmean[:-1],bfrac[:,:-1],axes=(0,1))
+    q = [50.*alpha,100.-50.*alpha]
+    return np.percentile(bfrac,q,axis=0), np.percentile(bmean,q,axis=0)
+
+def bootstrapCounts(cnts,hiceb,nboot=1000,alpha=0.05,seed=0,nproc=1,\
+                    maxbytes=2**28):
+    """ Percentile intervals of level 1-alpha of category fractions and
+        mean thickness of category counts cnts (ncat,...), e.g. sitd of
+        readEMCounts, with upper category boundaries hiceb. Return a
+        dict of fields frac, frac_lo, frac_hi (ncat,...) and mean,
+        mean_lo, mean_hi (...), masked where there are no counts.
+        Resamples of a chunk of cells take at most about maxbytes in
+        each of nproc processes. Each cell has its own random stream,
+        so results depend on neither nproc nor maxbytes. All nboot
+        resamples of a cell are kept for its percentiles, so maxbytes
+        must hold at least about nboot*(28*ncat+24) bytes, else
+        ValueError is raised.
+    """
+    cnts = np.ma.filled(cnts,0).astype(np.int64)
+    ncat, shape = cnts.shape[0], cnts.shape[1:]
+    hmean = hicatMean(np.asarray(hiceb))
+    icells = np.where(cnts.sum(axis=0)>0)
+    obs = cnts[(slice(None),)+icells]
+    # bytes of a cell: int32 counts of multinomialResample, float64
+    # fractions and mean thicknesses with their two copies in np.percentile
+    percell = nboot*(4*ncat+3*8*ncat+3*8)
+    if percell>maxbytes:
+        raise ValueError("%d resamples of a cell take %d bytes, over "\
+                         "maxbytes=%d!" % (nboot,percell,maxbytes))
+    chunk = int(maxbytes//percell)
+    # the random stream of a cell is seeded by seed, which may be
+    # a sequence too, and the flattened index of the cell
+    seeds = [int(s) for s in np.atleast_1d(seed)]
+    cells = np.ravel_multi_index(icells,shape) if shape else \
+            np.zeros(obs.shape[1],dtype=np.int64)
+    args = [(obs[:,k:k+chunk],hmean,nboot,alpha,seeds,cells[k:k+chunk]) \
+            for k in range(0,obs.shape[1],chunk)]
+    if nproc==1 or len(args)<2:
+        res = map(_bootstrapChunk,args)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            res = list(pool.map(_bootstrapChunk,args))
+    out = {}
+    for v, n in [('frac',ncat),('frac_lo',ncat),('frac_hi',ncat),\
+                 ('mean',None),('mean_lo',None),('mean_hi',None)]:
+        out[v] = np.ma.masked_all(((n,) if n else ())+shape)
+    if not res:
+        return out
+    qfrac = np.concatenate([r[0] for r in res],axis=2)
+    qmean = np.concatenate([r[1] for r in res],axis=1)
+    frac = obs/obs.sum(axis=0).astype(float)
+    out['frac'][(slice(None),)+icells] = frac
+    out['frac_lo'][(slice(None),)+icells] = qfrac[0]
+    out['frac_hi'][(slice(None),)+icells] = qfrac[1]
+    out['mean'][icells] = np.dot(hmean[:-1],frac[:-1])
+    out['mean_lo'][icells] = qmean[0]
+    out['mean_hi'][icells] = qmean[1]
+    return out
+
+def bootstrapSITD(fn,nboot=1000,alpha=0.05,seed=0,nproc=1,maxbytes=2**28,\
+                  fillValue=-1.e+20):
+    """ Add bootstrap intervals of every time record of the sitd output
+        fn of sampleEM2ORCA to it: sitd_lo, sitd_hi of the category
+        fractions and sitmean, sitmean_lo, sitmean_hi of the mean
+        thickness. Variables of an earlier run are overwritten.
+    """
+    fp = nc.Dataset(fn,'a')
+    sitd = fp.variables['sitd']
+    hiceb = np.array(fp.variables['hiceb'][:])
+    chunks = sitd.chunking()
+    chunks = None if chunks=='contiguous' else chunks
+    outs = {}
+    for v, dims, lname in \
+        [('sitd_lo',sitd.dimensions,'lower bound of the category fraction'),\
+         ('sitd_hi',sitd.dimensions,'upper bound of the category fraction'),\
+         ('sitmean',('time','y','x'),'mean EM ice thickness'),\
+         ('sitmean_lo',('time','y','x'),'lower bound of the mean thickness'),\
+         ('sitmean_hi',('time','y','x'),'upper bound of the mean thickness')]:
+        if v not in fp.variables:
+            csize = None if chunks is None else \
+                    (chunks if len(dims)==4 else chunks[:1]+chunks[2:])
+            outVar = fp.createVariable(v,'f',dims,fill_value=fillValue,\
+                                       zlib=True,chunksizes=csize)
+            outVar.units = 'm' if v.startswith('sitmean') else '1'
+            outVar.long_name = lname
+            outVar.coordinates = "time nav_lon nav_lat"
+        outs[v] = fp.variables[v]
+        outs[v].nboot = nboot
+        outs[v].confidence = 1.-alpha
+    for it in range(sitd.shape[0]):
+        ci = bootstrapCounts(sitd[it],hiceb,nboot,alpha,[seed,it],nproc,\
+                             maxbytes)
+        for v, k in [('sitd_lo','frac_lo'),('sitd_hi','frac_hi'),\
+                     ('sitmean','mean'),('sitmean_lo','mean_lo'),\
+                     ('sitmean_hi','mean_hi')]:
+            outs[v][it] = ci[k]
+        fp.sync()
+        print "Bootstrapped timestep=%d, %d cells" % \
+              (it,ci['mean'].count())
+    fp.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('sitd',nargs='+',help="sitd outputs of sampleEM2ORCA")
+    parser.add_argument('-n','--nboot',type=int,default=1000,\
+                        help="number of resamples")
+    parser.add_argument('--alpha',type=float,default=0.05,\
+                        help="intervals of confidence level 1-alpha")
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('-j','--nproc',type=int,default=1,\
+                        help="number of worker processes")
+    parser.add_argument('--maxmem',type=float,default=256.,\
+                        help="memory of resamples per process in MB")
+    args = parser.parse_args()
+    for fn in args.sitd:
+        bootstrapSITD(fn,nboot=args.nboot,alpha=args.alpha,seed=args.seed,\
+                      nproc=args.nproc,maxbytes=int(args.maxmem*2**20))
+    print "Finnished!"
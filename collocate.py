@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Collocate LIM3 model output with EM segments along the track.
+Every segment gets the category concentrations and thicknesses of its
+grid cell from the model record of its averaging period (freq as in
+sampleEM2ORCA), e.g. the daily or monthly mean of the segment day.
+Each icemod file is opened once and only the tiles of the grid
+touched by the track are read, values are gathered by fancy indexing.
+The result is an along-track table of model and EM thickness.
+"""
+
+__author__ = "<petteri.uotila@fmi.fi>"
+
+import sys
+import glob
+from datetime import datetime
+import numpy as np
+import netCDF4 as nc
+from antload import Antload, load_segments
+from sampleEM2ORCA import GRIDFILES, DATECORRECTIONS, FREQS, \
+                          periodKeys, correctDates, fileCorrection
+from instrument import NULL, getInstrument
+
+MODVARS = ['siconcat','sithicat','snthicat']
+
+TIMEUNITS = {'seconds':1,'minutes':60,'hours':3600,'days':86400}
+
+def recordTimes(fp):
+    """ Times of the records of an icemod file as datetime64[s],
+        the calendar is taken to be the standard one
+    """
+    tname = 'time_counter' if 'time_counter' in fp.variables else 'time'
+    tvar = fp.variables[tname]
+    step, origin = tvar.units.split(' since ')
+    origin = np.datetime64(origin.strip().replace(' ','T'),'s')
+    secs = np.round(np.asarray(tvar[:],dtype=np.float64)*TIMEUNITS[step.strip()])
+    return origin + secs.astype(np.int64).astype('timedelta64[s]')
+
+def modelRecords(fns,freq):
+    """ (file,record) of each record of icemod files fns, the period
+        keys and times of the records, sorted by key
+    """
+    recs, times = [], [np.zeros(0,dtype='datetime64[s]')]
+    for ifn, fn in enumerate(fns):
+        fp = nc.Dataset(fn)
+        times.append(recordTimes(fp))
+        fp.close()
+        recs += [(ifn,it) for it in range(len(times[-1]))]
+    times = np.hstack(times)
+    keys = periodKeys(times.astype('datetime64[D]'),freq)
+    order = np.argsort(keys,kind='mergesort')
+    if np.any(np.diff(keys[order])==0):
+        raise ValueError("Several model records in the same %s period!" % freq)
+    recs = np.array(recs,dtype=np.int64).reshape(-1,2)
+    return recs[order], keys[order], times[order]
+
+def gatherCells(var,its,rec,iy,ix,tile=64):
+    """ Values of var (time,cat,y,x) at records its[rec] and global
+        grid cells iy,ix of each point, shape (npoint,cat). Only tiles
+        of tile x tile cells with points are read, with the records of
+        their points.
+    """
+    ntx = -(-var.shape[3]//tile)
+    out = np.ma.masked_all((len(rec),var.shape[1]),dtype=var.dtype)
+    tid = (iy//tile)*ntx + ix//tile
+    order = np.argsort(tid,kind='mergesort')
+    utid, bnds = np.unique(tid[order],return_index=True)
+    bnds = np.hstack((bnds,len(order)))
+    for k, t in enumerate(utid):
+        sel = order[bnds[k]:bnds[k+1]]
+        y0, x0 = (t//ntx)*tile, (t%ntx)*tile
+        urec = np.unique(rec[sel])
+        block = np.ma.asarray(var[list(its[urec]),:,y0:y0+tile,x0:x0+tile])
+        out[sel] = block[np.searchsorted(urec,rec[sel]),:,\
+                         iy[sel]-y0,ix[sel]-x0]
+    return out
+
+def collocate(segfns,modfns,freq='1m',grid='orca025',\
+              corrections=DATECORRECTIONS,tile=64,instr=NULL):
+    """ Model category fields at the segments of segment files segfns
+        from icemod files modfns on grid, a dict of along-track arrays.
+        Segments without a model record of their period are masked.
+    """
+    columns = ['data','time','lat','lon','x','y']
+    objs = [load_segments(fn,columns=columns,instr=instr) for fn in segfns]
+    out = dict([(c,np.hstack([getattr(obj,c) for obj in objs])) \
+                for c in columns])
+    out['time'] = np.hstack([correctDates(obj.dates,\
+                                          fileCorrection(corrections,fn)) \
+                             for fn, obj in zip(segfns,objs)])
+    if grid!='orca025':
+        grd = Antload()
+        grd.readModelGrid(grdfile=GRIDFILES[grid])
+        with instr.timer('gridlookup'):
+            out['x'], out['y'] = grd.nearestGridIndices(out['lon'],out['lat'])
+    # model record of each segment
+    recs, keys, times = modelRecords(modfns,freq)
+    if len(keys)==0:
+        raise ValueError("No model records in %s!" % modfns)
+    segkeys = periodKeys(out['time'].astype('datetime64[D]'),freq)
+    irec = np.minimum(np.searchsorted(keys,segkeys),len(keys)-1)
+    found = keys[irec]==segkeys
+    instr.count('segments.read',len(segkeys))
+    instr.count('segments.collocated',found.sum())
+    nseg = len(segkeys)
+    flds = {}
+    for ifn, fn in enumerate(modfns):
+        sel = np.where(found & (recs[irec,0]==ifn))[0]
+        if len(sel)==0:
+            continue
+        fp = nc.Dataset(fn)
+        its = np.unique(recs[irec[sel],1])
+        rec = np.searchsorted(its,recs[irec[sel],1])
+        iy, ix = np.asarray(out['x'])[sel], np.asarray(out['y'])[sel]
+        for v in MODVARS:
+            var = fp.variables[v]
+            if v not in flds:
+                flds[v] = np.ma.masked_all((nseg,var.shape[1]),dtype='f4')
+            with instr.timer('gather'):
+                flds[v][sel] = gatherCells(var,its,rec,iy,ix,tile)
+        fp.close()
+    if not flds:
+        raise ValueError("No model records in the periods of the segments!")
+    out.update(flds)
+    out['modtime'] = np.ma.masked_where(~found,\
+                                        times[irec].astype(np.int64))
+    # grid cell means of the ice covered part, without and with snow
+    conc, hi, hs = [out[v] for v in MODVARS]
+    out['siconc'] = np.ma.sum(conc,axis=1)
+    out['sit'] = np.ma.sum(conc*hi,axis=1)/out['siconc']
+    out['sitsn'] = np.ma.sum(conc*(hi+hs),axis=1)/out['siconc']
+    return out
+
+# columns of the collocation table: (name, netCDF type, units, long name)
+TABLE_COLUMNS = [('time','i8','seconds since 1970-01-01 00:00:00',\
+                  'segment time'),\
+                 ('lat','f8','degrees_north','segment latitude'),\
+                 ('lon','f8','degrees_east','segment longitude'),\
+                 ('x','i4','1','row index of the model grid cell'),\
+                 ('y','i4','1','column index of the model grid cell'),\
+                 ('data','f4','m','EM ice thickness'),\
+                 ('modtime','i8','seconds since 1970-01-01 00:00:00',\
+                  'time of the model record'),\
+                 ('siconc','f4','1','model ice concentration'),\
+                 ('sit','f4','m','model ice thickness of the ice covered part'),\
+                 ('sitsn','f4','m','model ice and snow thickness '\
+                                  'of the ice covered part'),\
+                 ('siconcat','f4','1','model ice concentration per category'),\
+                 ('sithicat','f4','m','model ice thickness per category'),\
+                 ('snthicat','f4','m','model snow thickness per category')]
+
+def saveCollocation(out,fno,fillValue=-1.e+20):
+    """ Write the collocation table to netCDF, one variable per column
+    """
+    today = datetime.today()
+    fp = nc.Dataset(fno,'w')
+    setattr(fp,'history',"Created by <petteri.uotila@fmi.fi> on %s by %s." % \
+                         (today.strftime("%Y-%m-%d"),sys.argv[0]))
+    fp.createDimension('segment',len(out['data']))
+    fp.createDimension('ncatice',out['siconcat'].shape[1])
+    for vname, vtype, units, lname in TABLE_COLUMNS:
+        vals = out[vname]
+        if vname=='time':
+            vals = np.asarray(vals,dtype='datetime64[s]').astype(np.int64)
+        dims = ('segment',) if np.ndim(vals)==1 else ('segment','ncatice')
+        fill = fillValue if vtype=='f4' else None
+        outVar = fp.createVariable(vname,vtype,dims,fill_value=fill)
+        outVar[:] = vals
+        outVar.units = units
+        outVar.long_name = lname
+    fp.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('model',nargs='+',help="icemod files or glob patterns")
+    parser.add_argument('--segments',nargs='+',default=['antload??.nc'],\
+                        help="segment files or glob patterns")
+    parser.add_argument('--freq',default='1m',choices=FREQS,\
+                        help="averaging period of the model records")
+    parser.add_argument('--grid',default='orca025',\
+                        choices=sorted(GRIDFILES.keys()))
+    parser.add_argument('-o','--output',default='antload_collocated.nc')
+    parser.add_argument('--stats',default=None,metavar='FILE',\
+                        help="write timers and counters to a .json or .csv file")
+    args = parser.parse_args()
+    expand = lambda pats: sorted(sum([glob.glob(p) for p in pats],[]))
+    instr = getInstrument(args.stats is not None)
+    out = collocate(expand(args.segments),expand(args.model),freq=args.freq,\
+                    grid=args.grid,instr=instr)
+    saveCollocation(out,args.output)
+    print "Collocated %d of %d segments to %s" % \
+          (np.sum(~np.ma.getmaskarray(out['modtime'])),len(out['data']),\
+           args.output)
+    if args.stats is not None:
+        instr.report()
+        instr.write(args.stats)
+    print "Finnished!"
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+Nearest model grid cell lookup with a spatial index.
+Grid points are mapped to unit sphere xyz coordinates where the nearest
+chord distance is also the nearest great-circle distance, so a cKDTree
+gives the same neighbour as a brute-force search over the grid.
+The tree is built once per grid and cached to disk next to the grid file,
+or in the temporary directory if the grid file directory is read-only.
+"""
+
+__author__ = "<petteri.uotila@fmi.fi>"
+
+import os
+import gzip
+import cPickle
+import tempfile
+import numpy as np
+from scipy.spatial import cKDTree
+
+# trees already built in this process, keyed by cache key
+_trees = {}
+
+def lonlat2xyz(lon,lat):
+    """ Longitude and latitude in degrees to unit sphere xyz, shape (n,3)
+    """
+    lon = np.radians(np.asarray(lon,dtype=np.float64).ravel())
+    lat = np.radians(np.asarray(lat,dtype=np.float64).ravel())
+    clat = np.cos(lat)
+    return np.column_stack((clat*np.cos(lon),clat*np.sin(lon),np.sin(lat)))
+
+class GridIndex(object):
+    def __init__(self,grdlon,grdlat):
+        self.shape = grdlon.shape
+        self.tree = cKDTree(lonlat2xyz(grdlon,grdlat))
+
+    def query(self,lon,lat):
+        """ Return 0-based grid indices (x,y) of the nearest grid points,
+            x along the first and y along the second grid dimension
+            as in Antload.
+        """
+        dist, idx = self.tree.query(lonlat2xyz(lon,lat))
+        x, y = np.unravel_index(idx,self.shape)
+        return x.astype(np.int32), y.astype(np.int32)
+
+def cacheKey(grdfile,shape):
+    st = os.stat(grdfile)
+    return (os.path.abspath(grdfile),int(st.st_mtime),st.st_size,tuple(shape))
+
+def cacheFile(grdfile,shape):
+    """ Tree cache file next to grdfile, or in the temporary directory
+        if the directory of grdfile is not writable
+    """
+    name = "%s.%dx%d.kdtree.cpickle.gz" % ((os.path.basename(grdfile),)+shape)
+    cachedir = os.path.dirname(os.path.abspath(grdfile))
+    if not os.access(cachedir,os.W_OK):
+        cachedir = tempfile.gettempdir()
+    return os.path.join(cachedir,name)
+
+def getGridIndex(grdlon,grdlat,grdfile=None,cachefile=None):
+    """ GridIndex for grid (grdlon,grdlat), read from or written to
+        a disk cache if the grid was read from grdfile.
+    """
+    if grdfile is None:
+        return GridIndex(grdlon,grdlat)
+    key = cacheKey(grdfile,grdlon.shape)
+    if key in _trees:
+        return _trees[key]
+    if cachefile is None:
+        cachefile = cacheFile(grdfile,grdlon.shape)
+    gidx = None
+    if os.path.exists(cachefile):
+        try:
+            with gzip.open(cachefile,'rb') as f:
+                ckey, gidx = cPickle.load(f)
+            if ckey!=key:
+                gidx = None
+        except (IOError, EOFError, cPickle.UnpicklingError), e:
+            # e.g. a cache left half-written, rebuild it
+            print "Rebuilding the bad grid index cache %s: %s" % (cachefile,e)
+            gidx = None
+    if gidx is None:
+        gidx = GridIndex(grdlon,grdlat)
+        writeCache(cachefile,(key,gidx))
+    _trees[key] = gidx
+    return gidx
+
+def writeCache(cachefile,obj):
+    """ Write obj to a temporary file renamed to cachefile when complete,
+        so that an interrupted write never leaves a partial cache
+    """
+    tmpfile = None
+    try:
+        fd, tmpfile = tempfile.mkstemp(prefix=os.path.basename(cachefile)+'.',\
+                                       dir=os.path.dirname(cachefile) or '.')
+        with os.fdopen(fd,'wb') as fo:
+            with gzip.GzipFile(fileobj=fo,mode='wb') as f:
+                cPickle.dump(obj,f,-1)
+        os.chmod(tmpfile,0644)
+        os.rename(tmpfile,cachefile)
+    except (IOError, OSError), e:
+        print "Could not cache the grid index to %s: %s" % (cachefile,e)
+        if tmpfile is not None and os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+def benchGridIndex(grdfile="coordinates_ORCA025.nc",nobs=100000,tol=1.e-6):
+    """ Time the cKDTree lookup against the Fortran brute-force search
+        for random points over the grid. Raise AssertionError unless
+        indices agree or, for ties, both grid points are equally near
+        within tol relative distance.
+    """
+    from time import time
+    from antload import Antload
+    from GeoInterpolate_f90r import geointerpolate_f90r as gi
+    antload = Antload()
+    antload.readModelGrid(grdfile=grdfile)
+    ii = np.random.randint(0,antload.grdlon.size,nobs)
+    lon = antload.grdlon.ravel()[ii] + np.random.uniform(-.1,.1,nobs)
+    lat = antload.grdlat.ravel()[ii] + np.random.uniform(-.05,.05,nobs)
+    t0 = time()
+    gidx = GridIndex(antload.grdlon,antload.grdlat)
+    tb = time()-t0
+    t0 = time()
+    x, y = gidx.query(lon,lat)
+    tq = time()-t0
+    t0 = time()
+    min_i = gi.nearest_neighbour_indices(lon,lat,\
+                                         antload.grdlon,antload.grdlat,\
+                                         antload.gx,antload.gy,len(lon))
+    tf = time()-t0
+    fx, fy = min_i[:,0]-1, min_i[:,1]-1
+    same = (x==fx)&(y==fy)
+    print "nobs=%d kdtree build %6.3f s, query %6.3f s, fortran %6.3f s" % \
+          (nobs,tb,tq,tf)
+    print "identical indices %d/%d" % (same.sum(),nobs)
+    # differing indices must be ties: equally near grid points
+    xyz = lonlat2xyz(lon,lat)
+    dk = np.sqrt(np.sum((xyz-lonlat2xyz(antload.grdlon[x,y],\
+                                        antload.grdlat[x,y]))**2,axis=1))
+    df = np.sqrt(np.sum((xyz-lonlat2xyz(antload.grdlon[fx,fy],\
+                                        antload.grdlat[fx,fy]))**2,axis=1))
+    bad = ~same & (np.abs(dk-df)>tol*np.maximum(df,1.e-12))
+    if bad.any():
+        i = np.where(bad)[0][0]
+        raise AssertionError("%d lookups differ from the Fortran search, e.g. "\
+                             "lon=%g lat=%g kdtree (%d,%d) fortran (%d,%d)" % \
+                             (bad.sum(),lon[i],lat[i],x[i],y[i],fx[i],fy[i]))
+    print "ties %d, all lookups agree" % (~same).sum()
+
+if __name__ == "__main__":
+    benchGridIndex()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Named timers and counters of processing stages, e.g.
+    with instr.timer('loadmat'):
+        ...
+    instr.count('segments.read',nseg)
+Timers accumulate wall time and calls, counters any numbers such as
+segments or bytes. A stage can also be profiled with cProfile.
+Disabled instrumentation is the shared NULL object whose timers and
+counters do nothing, so instrumented code can always run with it.
+"""
+
+__author__ = "<petteri.uotila@fmi.fi>"
+
+import csv
+import json
+import cProfile
+from collections import OrderedDict
+from time import time as walltime
+
+class _Timer(object):
+    def __init__(self,instr,name):
+        self.instr = instr
+        self.name = name
+
+    def __enter__(self):
+        self.prof = self.instr.profiles.get(self.name)
+        if self.prof is not None:
+            self.prof.enable()
+        self.t0 = walltime()
+        return self
+
+    def __exit__(self,*exc):
+        dt = walltime()-self.t0
+        if self.prof is not None:
+            self.prof.disable()
+        tmr = self.instr.timers.setdefault(self.name,[0.,0])
+        tmr[0] += dt
+        tmr[1] += 1
+        return False
+
+class Instrument(object):
+    enabled = True
+
+    def __init__(self,profile=[]):
+        """ Stages in profile are also profiled with cProfile
+        """
+        self.timers = OrderedDict() # name: [seconds,calls]
+        self.counters = OrderedDict()
+        self.profiles = dict([(name,cProfile.Profile()) for name in profile])
+        self.t0 = walltime()
+
+    def timer(self,name):
+        return _Timer(self,name)
+
+    def count(self,name,n=1):
+        self.counters[name] = self.counters.get(name,0) + n
+
+    def summary(self):
+        """ Timers and counters as a dict, e.g. to return from a worker
+        """
+        return {'wall':walltime()-self.t0,\
+                'timers':OrderedDict([(k,{'seconds':v[0],'calls':v[1]}) \
+                                      for k,v in self.timers.items()]),\
+                'counters':OrderedDict(self.counters)}
+
+    def merge(self,summary):
+        """ Add timers and counters of a summary of another process
+        """
+        if not summary:
+            return
+        for name, tmr in summary['timers'].items():
+            mine = self.timers.setdefault(name,[0.,0])
+            mine[0] += tmr['seconds']
+            mine[1] += tmr['calls']
+        for name, n in summary['counters'].items():
+            self.count(name,n)
+
+    def report(self):
+        out = self.summary()
+        print "Wall time %.3f s" % out['wall']
+        for name, tmr in out['timers'].items():
+            print "  %-20s %10.3f s %8d calls" % (name,tmr['seconds'],tmr['calls'])
+        for name, n in out['counters'].items():
+            print "  %-20s %14d" % (name,n)
+
+    def write(self,fn):
+        """ Write the summary to fn, CSV if it ends with .csv, else JSON.
+            Profiled stages are written to fn.<stage>.prof for pstats.
+        """
+        out = self.summary()
+        if fn.endswith('.csv'):
+            with open(fn,'wb') as f:
+                writer = csv.writer(f)
+                writer.writerow(['kind','name','value','calls'])
+                writer.writerow(['timer','wall',out['wall'],1])
+                for name, tmr in out['timers'].items():
+                    writer.writerow(['timer',name,tmr['seconds'],tmr['calls']])
+                for name, n in out['counters'].items():
+                    writer.writerow(['counter',name,n,''])
+        else:
+            with open(fn,'w') as f:
+                json.dump(out,f,indent=1)
+        self.writeProfiles(fn)
+
+    def writeProfiles(self,prefix):
+        """ Write profiled stages to prefix.<stage>.prof for pstats
+        """
+        for name, prof in self.profiles.items():
+            prof.dump_stats("%s.%s.prof" % (prefix,name))
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        return False
+
+class NullInstrument(object):
+    enabled = False
+    _timer = _NullTimer()
+
+    def timer(self,name):
+        return self._timer
+
+    def count(self,name,n=1):
+        pass
+
+    def summary(self):
+        return None
+
+    def merge(self,summary):
+        pass
+
+    def report(self):
+        pass
+
+    def write(self,fn):
+        pass
+
+    def writeProfiles(self,prefix):
+        pass
+
+NULL = NullInstrument()
+
+def getInstrument(enabled=False,profile=[]):
+    """ An Instrument if enabled or stages are profiled, else NULL
+    """
+    if enabled or profile:
+        return Instrument(profile)
+    return NULL
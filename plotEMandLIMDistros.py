@@ -4,74 +4,205 @@ Simple plotting of one grid cell ice thickness distributions, observed and
 modelled. Might evolve to something bigger.
 """
 
+import os
 import sys
+import glob
+import hashlib
+from collections import OrderedDict
 import numpy as np
 import netCDF4 as nc
 import matplotlib.pylab as plt
 from matplotlib import colors
-from scipy.stats import ks_2samp
+from cellstats import fieldTests
+from region import Region
+
+def emEquivalentConcentration(siconcat,sithicat,snthicat,axis=0):
+    """ Convert LIM3 category concentrations to the categories EM sees,
+        all fields with categories along axis and any other dimensions.
+    """
+    siconcat, sithicat, snthicat = [np.rollaxis(np.ma.asarray(v),axis) \
+                                    for v in (siconcat,sithicat,snthicat)]
+    sinthicat = sithicat + snthicat # ice + snow thickness
+    # used category thickness as sithicat + snthicat as EM sees the ice
+    # adjust category bounds back so that they correspod to ice thickness
+    # category bounds: snow of the category below is added to categories
+    # 2..N and the last category keeps its own snow too
+    hiEM = np.ma.array(sithicat,copy=True)
+    hiEM[1:] += snthicat[:-1]
+    hiEM[-1] += snthicat[-1]
+    siconcatEM = siconcat*hiEM/sinthicat
+    # normalise sitd so that its sum per grid cell is one
+    # effectively convert volume to thickness
+    siconcatEM /= np.ma.sum(siconcatEM,axis=0)
+    return np.rollaxis(siconcatEM,0,axis+1)
 
 class LIM3SITD(object):
-    def __init__(self,fn,tidx=0):
-        """ Assume monthly files with one time record
+    def __init__(self,fn,tidx=0,region=None):
+        """ fn is an icemod file, a list of them or a glob pattern
+            whose time records are concatenated in file name order.
+            tidx selects records of the concatenated time axis: an index
+            gives (ncat,y,x) fields, a list or None (all records)
+            (nt,ncat,y,x) fields in time order.
+            Only the Region region of the global grid is read if given.
         """
+        if isinstance(fn,basestring):
+            fns = sorted(glob.glob(fn)) if glob.has_magic(fn) else [fn]
+        else:
+            fns = list(fn)
+        recs = []
+        for ifn, fname in enumerate(fns):
+            fp = nc.Dataset(fname)
+            recs += [(ifn,it) for it in range(fp.variables['siconcat'].shape[0])]
+            fp.close()
+        single = np.isscalar(tidx)
+        if tidx is None:
+            tidx = range(len(recs))
+        recs = np.array(recs)[np.sort(np.atleast_1d(tidx))]
+        flds = dict([(v,[]) for v in ['siconcat','sithicat','snthicat']])
+        for ifn in np.unique(recs[:,0]):
+            # read only the selected records, each file once
+            its = list(recs[recs[:,0]==ifn,1])
+            fp = nc.Dataset(fns[ifn])
+            if region is None:
+                region = Region.full(fp.variables['nav_lat'].shape)
+            sy, sx = region.slices
+            for v in flds:
+                flds[v].append(np.ma.array(fp.variables[v][its,:,sy,sx]))
+            if ifn==recs[0,0]:
+                self.lat = np.array(fp.variables['nav_lat'][sy,sx])
+                self.lon = np.array(fp.variables['nav_lon'][sy,sx])
+            fp.close()
+        self.region = region
+        flds = dict([(v,np.ma.concatenate(flds[v])) for v in flds])
+        self.siconcat = emEquivalentConcentration(flds['siconcat'],\
+                                                  flds['sithicat'],\
+                                                  flds['snthicat'],axis=1)
+        if single:
+            self.siconcat = self.siconcat[0]
+
+# recently read EM count fields, least recently used first
+_emcache = OrderedDict()
+EMCACHE_SIZE = 8
+
+def readEMCounts(fn,tidx=None,region=None,cachedir=None):
+    """ EM category counts of fn summed over time records tidx
+        (an index, a list or None for all), zero counts masked.
+        region is a Region of the global grid, 'track' for the bounding
+        box of cells with observations or None for the whole file.
+        Results are cached in memory and optionally in cachedir,
+        keyed by file mtime, time selection and region.
+    """
+    tsel = None if tidx is None else tuple(np.atleast_1d(tidx).tolist())
+    key = (os.path.abspath(fn),os.path.getmtime(fn),tsel,repr(region))
+    if key in _emcache:
+        _emcache[key] = _emcache.pop(key)
+        return _emcache[key]
+    fcache = None
+    if cachedir is not None:
+        fcache = os.path.join(cachedir,"emsitd_%s.npz" % \
+                              hashlib.md5(repr(key)).hexdigest())
+    if fcache is not None and os.path.exists(fcache):
+        npz = np.load(fcache)
+        out = dict([(k,npz[k]) for k in npz.files])
+        out['sitd'] = np.ma.masked_equal(out['sitd'],0)
+    else:
         fp = nc.Dataset(fn)
-        siconcat = np.ma.array(fp.variables['siconcat'][tidx])
-        sithicat = np.ma.array(fp.variables['sithicat'][tidx])
-        snthicat = np.ma.array(fp.variables['snthicat'][tidx])
-        sinthicat = sithicat + snthicat # ice + snow thickness
-        # used category thickness as sithicat + snthicat as EM sees the ice
-        # adjust category bounds back so that they correspod to ice thickness
-        # category bounds
-        siconcatEM = np.ma.zeros(siconcat.shape)
-        # first category
-        siconcatEM[0] = siconcat[0]*sithicat[0]/sinthicat[0]
-        # 2..N-1 categories
-        siconcatEM[1:-1] = np.ma.array([siconcat[i]*\
-                                       (snthicat[i-1]+sithicat[i])/sinthicat[i] \
-                                        for i in range(1,len(siconcat)-1)])
-        # Nth category
-        siconcatEM[-1] = siconcat[-1]*(snthicat[-2]+snthicat[-1]+sithicat[-1])/sinthicat[-1]
-        # normalise sitd so that its sum per grid cell is one
-        # effectively convert volume to thickness
-        self.siconcat = np.ma.array([siconcatEM[i,:,:]/np.sum(siconcatEM,axis=0) \
-                                     for i in range(siconcatEM.shape[0])])
-        self.lat = np.array(fp.variables['nav_lat'])
-        self.lon = np.array(fp.variables['nav_lon'])
+        var = fp.variables['sitd']
+        its = range(var.shape[0]) if tsel is None else tsel
+        fregion = Region.fromNetCDF(fp,var.shape[2:])
+        if isinstance(region,Region):
+            sy, sx = region.within(fregion)
+        else:
+            sy, sx = slice(None), slice(None)
+        # one time record in memory at a time
+        sitd = 0.
+        for it in its:
+            sitd = sitd + np.ma.filled(var[it,:,sy,sx],0)
+        if region=='track':
+            iy, ix = np.where(sitd.sum(axis=0)>0)
+            region = Region.fromIndices(*fregion.toGlobal(iy,ix)) \
+                     if len(iy) else fregion
+            sy, sx = region.within(fregion)
+            sitd = sitd[:,sy,sx]
+        elif region is None:
+            region = fregion
+        out = {'sitd':np.ma.masked_equal(sitd,0),\
+               'hiceb':np.array(fp.variables['hiceb'][:]),\
+               'lat':np.array(fp.variables['nav_lat'][sy,sx]),\
+               'lon':np.array(fp.variables['nav_lon'][sy,sx]),\
+               'region':np.array([region.y0,region.y1,region.x0,region.x1])}
         fp.close()
+        if fcache is not None:
+            np.savez(fcache,**dict(out,sitd=out['sitd'].filled(0)))
+    _emcache[key] = out
+    while len(_emcache)>EMCACHE_SIZE:
+        _emcache.popitem(last=False)
+    return out
 
 class EMSITD(object):
-    def __init__(self,fn,tidx=0):
-        fp = nc.Dataset(fn)
-        sitd = np.ma.sum(fp.variables['sitd'][tidx,:,:,:],axis=0)
+    def __init__(self,fn,tidx=0,region=None,cachedir=None):
+        """ EM ice thickness distributions of time records tidx of fn,
+            see readEMCounts for region and cachedir.
+        """
+        em = readEMCounts(fn,tidx,region,cachedir)
+        sitd = em['sitd']
+        self.region = Region(*em['region'])
         # number of processed 100m EM observations per grid cell
         self.cnt = np.ma.sum(sitd,axis=0)
         # normalise sitd so that its sum per grid cell is one
-        self.sitd = np.ma.array([sitd[i,:,:]/np.sum(sitd,axis=0) \
-                                 for i in range(sitd.shape[0])])
+        self.sitd = sitd/self.cnt
         # upper boundaries of ice thicness category limits
-        hiceb = np.ma.array(fp.variables['hiceb'])
+        hiceb = em['hiceb']
         # add lower boundary (0) and change upper boudary (5)
         self.hicats = np.hstack(([0],hiceb[:-1],[5]))
         # mean of ice categories thicknesses
         self.hicatmean = (self.hicats[1:]+self.hicats[:-1])/2
-        self.lat = np.array(fp.variables['nav_lat'])
-        self.lon = np.array(fp.variables['nav_lon'])
-        fp.close()
+        self.lat = em['lat']
+        self.lon = em['lon']
+
+# map projection of mapPlot
+MAPPARAMS = dict(width=600000,height=600000,\
+                 projection='laea',resolution='h',\
+                 lat_ts=-69,lat_0=-69,lon_0=-6.)
+
+# Basemaps already set up, keyed by their parameters
+_basemaps = {}
+
+def getBasemap(**kwargs):
+    key = tuple(sorted(kwargs.items()))
+    if key not in _basemaps:
+        from mpl_toolkits.basemap import Basemap
+        _basemaps[key] = Basemap(**kwargs)
+    return _basemaps[key]
+
+# PlotObsMods of plotSITDs, inherited by its forked workers
+_ompl = None
+
+def _plotSITDWorker(args):
+    plt.switch_backend('Agg')
+    return _ompl.plotSITD(*args)
 
 class PlotObsMods(object):
     def __init__(self,obs,mod):
         self.obs = obs
         self.mod = mod
+        self.mapfig = None
 
     def plotSITD(self,iy,ix,title='Jan 2014'):
+        """ Distributions of the cell at global grid indices iy,ix
+        """
         obs = self.obs
         mod = self.mod
-        plat = obs.lat[iy,ix]
-        plon = obs.lon[iy,ix]
-        nobs = obs.cnt[iy,ix]
-        hiobs = obs.sitd[:,iy,ix]
-        himod = mod.siconcat[:,iy,ix]
+        oy, ox, oinside = obs.region.toLocal(iy,ix)
+        my, mx, minside = mod.region.toLocal(iy,ix)
+        for inside, region in [(oinside,obs.region),(minside,mod.region)]:
+            if not np.all(inside):
+                raise ValueError("Cell (%d,%d) is outside %s!" % (iy,ix,region))
+        plat = obs.lat[oy,ox]
+        plon = obs.lon[oy,ox]
+        nobs = obs.cnt[oy,ox]
+        hiobs = obs.sitd[:,oy,ox]
+        himod = mod.siconcat[:,my,mx]
         # mean values (skip the last category):
         mhiobs = np.ma.sum(obs.hicatmean[:-1]*hiobs[:-1])
         mhimod = np.ma.sum(obs.hicatmean[:-1]*himod[:-1])
@@ -87,48 +218,78 @@ class PlotObsMods(object):
         ax.set_ylabel('ice concentration [0-1]')
         ax.legend(lnes,("obs, <%4.2f m>" % mhiobs,"model, <%4.2f m>" % mhimod))
         ax.set_title("%s, %5.1f E,%4.1f N, N$_{obs}$=%d" % (title,plon,plat,nobs))
-        plt.savefig('sitd_%s_y%d_x%d.png' % (title.replace(' ','_'),iy,ix))
+        fno = 'sitd_%s_y%d_x%d.png' % (title.replace(' ','_'),iy,ix)
+        fig.savefig(fno)
+        plt.close(fig)
+        return fno
 
-    def mapPlot(self,fld,title='p-values Jan 2014'):
-        from mpl_toolkits.basemap import Basemap
-        m = Basemap(width=600000,height=600000,\
-                    projection='laea',resolution='h',\
-                    lat_ts=-69,lat_0=-69,lon_0=-6.)
-        x,y = m(self.obs.lon,self.obs.lat)
-        fig = plt.figure()
-        ax = fig.add_subplot(1,1,1)
+    def plotSITDs(self,cells,title='Jan 2014',nproc=None):
+        """ plotSITD of global grid cells [(iy,ix),...] in worker
+            processes on the non-interactive Agg backend
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        global _ompl
+        _ompl = self
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            return list(pool.map(_plotSITDWorker,\
+                                 [(iy,ix,title) for iy,ix in cells]))
+
+    def getMap(self):
+        """ Map figure with coastlines and the projected grid,
+            set up on the first call and reused by later maps
+        """
+        if self.mapfig is None:
+            m = getBasemap(**MAPPARAMS)
+            self.mx, self.my = m(self.obs.lon,self.obs.lat)
+            fig = plt.figure()
+            ax = fig.add_subplot(1,1,1)
+            m.drawcoastlines(ax=ax)
+            m.drawmeridians(np.arange(-30,14,4),labels=[0,0,0,1],ax=ax)
+            m.drawparallels(np.arange(-70,-50,2),labels=[1,0,0,0],ax=ax)
+            self.map, self.mapfig, self.mapax = m, fig, ax
+        return self.map, self.mapfig, self.mapax
+
+    def mapPlots(self,flds,titles):
+        """ Maps of several fields on the same map figure
+        """
+        m, fig, ax = self.getMap()
         bounds = np.array([0, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 1])
         norm = colors.BoundaryNorm(boundaries=bounds, ncolors=256)
-        m.pcolormesh(x,y,fld,norm=norm,cmap=plt.get_cmap('RdYlGn'))
-        m.drawcoastlines()
-        m.drawmeridians(np.arange(-30,14,4),labels=[0,0,0,1])
-        m.drawparallels(np.arange(-70,-50,2),labels=[1,0,0,0])
-        m.colorbar()
-        plt.savefig('map_%s.png' % title.replace(' ','_'))
+        fnos = []
+        for fld, title in zip(flds,titles):
+            mesh = m.pcolormesh(self.mx,self.my,fld,norm=norm,\
+                                cmap=plt.get_cmap('RdYlGn'),ax=ax)
+            cbar = m.colorbar(mesh,ax=ax)
+            fnos.append('map_%s.png' % title.replace(' ','_'))
+            fig.savefig(fnos[-1])
+            # keep coastlines and grid lines for the next field
+            fig.delaxes(cbar.ax)
+            mesh.remove()
+        return fnos
+
+    def mapPlot(self,fld,title='p-values Jan 2014'):
+        return self.mapPlots([fld],[title])[0]
+
+    def close(self):
+        """ Close the map figure
+        """
+        if self.mapfig is not None:
+            plt.close(self.mapfig)
+            self.mapfig = None
 
 if __name__ == "__main__":
     fon = 'antload_1m_sitd.nc'
     imonths = [1,2] # Jan and early Feb 2014
-    emdata = EMSITD(fon,tidx=imonths)
+    emdata = EMSITD(fon,tidx=imonths,region='track')
     fmn = 'NO02_1m_20140101_20140131_icemod.nc'
     #fmn = 'NO02_1m_20140201_20140228_icemod.nc'
-    limdata = LIM3SITD(fmn)
+    limdata = LIM3SITD(fmn,region=emdata.region)
     # calculate KS stats per grid cell
-    pvals = np.ma.zeros(emdata.lat.shape)
-    pvals.mask = True
-    for iy in range(emdata.lat.shape[0]):
-        for ix in range(emdata.lat.shape[1]):
-            if emdata.sitd[:-1,iy,ix].mask.any(): continue
-            if limdata.siconcat[:-1,iy,ix].mask.any(): continue
-            tval, pvals[iy,ix] = ks_2samp(emdata.sitd[:-1,iy,ix],\
-                                          limdata.siconcat[:-1,iy,ix])
+    pvals = fieldTests(emdata.sitd[:-1],limdata.siconcat[:-1],['ks'])['ks']
     # plotting
     ompl = PlotObsMods(emdata,limdata)
     # sitd plots
-    iy, ix = 108, 1123 # (where pval is high)
-    ompl.plotSITD(iy,ix)
-    iy, ix = 94, 1118 # (where pval is low)
-    ompl.plotSITD(iy,ix)
-    iy, ix = 100, 1143 # (where pval is around 0.5)
-    ompl.plotSITD(iy,ix)
+    ompl.plotSITDs([(108,1123),  # (where pval is high)
+                    (94,1118),   # (where pval is low)
+                    (100,1143)]) # (where pval is around 0.5)
     print "Finnished!"
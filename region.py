@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Region of interest as an index window of the global ORCA grid.
+Grid readers, sampled EM distributions and plots keep only the window,
+its offsets map cropped arrays back to global (iy,ix) indices.
+Global row indices of the southern subdomain read by
+Antload.readModelGrid are the same as those of the full ORCA grid.
+"""
+
+__author__ = "<petteri.uotila@fmi.fi>"
+
+import numpy as np
+
+class Region(object):
+    def __init__(self,y0,y1,x0,x1):
+        """ Rows y0:y1 and columns x0:x1 of the global grid
+        """
+        self.y0, self.y1 = int(y0), int(y1)
+        self.x0, self.x1 = int(x0), int(x1)
+
+    def __repr__(self):
+        return "Region(%d,%d,%d,%d)" % (self.y0,self.y1,self.x0,self.x1)
+
+    def __eq__(self,other):
+        return isinstance(other,Region) and \
+               (self.y0,self.y1,self.x0,self.x1)==\
+               (other.y0,other.y1,other.x0,other.x1)
+
+    def __ne__(self,other):
+        return not self==other
+
+    @property
+    def shape(self):
+        return (self.y1-self.y0,self.x1-self.x0)
+
+    @property
+    def slices(self):
+        return (slice(self.y0,self.y1),slice(self.x0,self.x1))
+
+    @classmethod
+    def full(cls,shape):
+        return cls(0,shape[0],0,shape[1])
+
+    @classmethod
+    def fromIndices(cls,iy,ix,pad=0,shape=None):
+        """ Bounding box of global indices, e.g. Antload.x and Antload.y
+            of the observed track, widened by pad cells
+        """
+        y0, y1 = np.min(iy)-pad, np.max(iy)+pad+1
+        x0, x1 = np.min(ix)-pad, np.max(ix)+pad+1
+        if shape is not None:
+            y1, x1 = min(y1,shape[0]), min(x1,shape[1])
+        return cls(max(y0,0),y1,max(x0,0),x1)
+
+    @classmethod
+    def fromLatLonBox(cls,grdlat,grdlon,latmin,latmax,lonmin,lonmax,pad=0):
+        """ Bounding box of grid cells inside a lat/lon box,
+            longitudes in degrees east between -180 and 180
+        """
+        lon = (np.asarray(grdlon)+180.)%360.-180.
+        iy, ix = np.where((grdlat>=latmin)&(grdlat<=latmax)&\
+                          (lon>=lonmin)&(lon<=lonmax))
+        if len(iy)==0:
+            raise ValueError("No grid cells in the lat/lon box!")
+        return cls.fromIndices(iy,ix,pad,np.shape(grdlat))
+
+    def crop(self,fld):
+        """ Window of a global field, grid in the last two dimensions
+        """
+        return fld[(Ellipsis,)+self.slices]
+
+    def within(self,other):
+        """ Slices of this region in the arrays of a region other
+            containing it
+        """
+        if self.y0<other.y0 or self.y1>other.y1 or \
+           self.x0<other.x0 or self.x1>other.x1:
+            raise ValueError("%s is not within %s!" % (self,other))
+        return (slice(self.y0-other.y0,self.y1-other.y0),\
+                slice(self.x0-other.x0,self.x1-other.x0))
+
+    def toLocal(self,iy,ix):
+        """ Global to local indices and whether they are in the region
+        """
+        ly, lx = np.asarray(iy)-self.y0, np.asarray(ix)-self.x0
+        inside = (ly>=0)&(ly<self.y1-self.y0)&(lx>=0)&(lx<self.x1-self.x0)
+        return ly, lx, inside
+
+    def toGlobal(self,iy,ix):
+        return np.asarray(iy)+self.y0, np.asarray(ix)+self.x0
+
+    def setNetCDFAttrs(self,fp):
+        fp.roi = np.array([self.y0,self.y1,self.x0,self.x1],dtype='i4')
+
+    @classmethod
+    def fromNetCDF(cls,fp,shape):
+        """ Region stored in the attributes of fp, or the full grid
+            of the given shape for files without one
+        """
+        if 'roi' in fp.ncattrs():
+            return cls(*np.atleast_1d(fp.roi))
+        return cls.full(shape)
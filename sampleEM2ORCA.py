@@ -6,19 +6,101 @@ the default five categories, at first at least.
 antload.py must be run before to know t,x,y
 Measurements 2013-14 campaigns are used.
 Save to netCDF.
+Several temporal resolutions (FREQS) and ORCA grids (GRIDFILES)
+can be sampled in one pass, each to its own netCDF file.
 """
 
+import os
 import sys
 import glob
+import shutil
+import hashlib
 from datetime import datetime, timedelta
 import numpy as np
 import netCDF4 as nc
 from netcdftime import utime
-from antload import Antload, load_zipped_pickle
+from antload import Antload, load_segments
+from region import Region
+from instrument import NULL, getInstrument
+
+GRIDFILES = {'orca1':'coordinates_ORCA1.nc',\
+             'orca025':'coordinates_ORCA025.nc',\
+             'orca12':'coordinates_ORCA12.nc'}
+
+def periodKeys(days,freq):
+    """ Integer key of the averaging period of each datetime64[D] day,
+        freq is one of FREQS.
+    """
+    if freq=='1m':
+        return days.astype('datetime64[M]').astype(np.int64)
+    n = days.astype(np.int64) # days since 1970-01-01, a Thursday
+    if freq=='1d':
+        return n
+    if freq=='5d':
+        return n//5
+    if freq=='1w':
+        return (n+3)//7 # weeks starting on Monday
+    raise ValueError("Frequency %s not implemented!" % freq)
+
+FREQS = ['1d','5d','1w','1m']
+
+def shiftYears(days,yoffset):
+    """ Add yoffset years to datetime64 days, any unit from days to seconds
+    """
+    if yoffset==0:
+        return days
+    months = days.astype('datetime64[M]')
+    return (months+12*yoffset).astype(days.dtype) + (days-months)
+
+# corrections of segment file dates by file name: years and seconds to add
+DATECORRECTIONS = {'antload17.nc':{'years':1}} # wrong year (2013 not 2014)
+
+def fileCorrection(corrections,fn):
+    """ Date correction of segment file fn given with or without directory
+    """
+    return corrections.get(fn,corrections.get(os.path.basename(fn),{}))
+
+def correctDates(dates,correction={}):
+    """ Apply a DATECORRECTIONS entry to datetime64 dates
+    """
+    dates = shiftYears(dates,correction.get('years',0))
+    return dates + np.timedelta64(correction.get('seconds',0),'s')
+
+def day2datetime(day):
+    """ datetime64[D] to datetime
+    """
+    d = day.astype(datetime)
+    return datetime(d.year,d.month,d.day)
+
+def md5sum(fn,blocksize=2**20):
+    md5 = hashlib.md5()
+    with open(fn,'rb') as f:
+        for block in iter(lambda: f.read(blocksize),''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def outputFile(grid,freq,kind='sitd'):
+    """ kind is 'sitd' for category counts, 'hist' for fine histograms
+    """
+    if grid=='orca025':
+        return "antload_%s_%s.nc" % (freq,kind)
+    return "antload_%s_%s_%s.nc" % (freq,grid,kind)
 
 class obsIceThickDistr(Antload):
-    def __init__(self,fno,grid='orca025',ncatice=5,hiceb=None):
-        self.grid = 'orca025'
+    def __init__(self,fno,grid='orca025',ncatice=5,hiceb=None,freq='1m',\
+                 append=False,region=None,instr=NULL):
+        """ Output to fno on grid, optionally only in region given as a
+            Region or a (latmin,latmax,lonmin,lonmax) box. Appending to
+            an existing file keeps its region. The output is written to
+            a working copy fno.part renamed to fno by close, so that an
+            interrupted run leaves fno as it was.
+        """
+        Antload.__init__(self,instr=instr)
+        if grid not in GRIDFILES:
+            raise ValueError("Grid %s not implemented!" % grid)
+        periodKeys(np.zeros(0,dtype='datetime64[D]'),freq)
+        self.grid = grid
+        self.freq = freq
         self.ncatice = ncatice
         # ice thickness category boundaries copied from ocean.output
         if hiceb is None:
@@ -30,15 +112,33 @@ class obsIceThickDistr(Antload):
                                    99.0000000000000])
         else:
             self.hiceb = hiceb
-        if grid=='orca025':
-            self.grdfile='coordinates_ORCA025.nc'
-            self.readModelGrid(self.grdfile)
+        self.readModelGrid(grdfile=GRIDFILES[grid])
+        if append and os.path.exists(fno):
+            fp = nc.Dataset(fno)
+            region = Region.fromNetCDF(fp,(len(fp.dimensions['y']),\
+                                           len(fp.dimensions['x'])))
+            fp.close()
+        elif isinstance(region,tuple):
+            region = Region.fromLatLonBox(self.grdlat,self.grdlon,*region)
+        if region is not None:
+            self.cropModelGrid(region)
+        self.fno = fno
+        self.partfile = fno+'.part'
+        if append and os.path.exists(fno):
+            shutil.copyfile(fno,self.partfile)
+            self.openNetCDF(self.partfile)
         else:
-            print "Grid %s not implemented!" % grid
-            sys.exit(0)
-        self.initNetCDF(fno)
+            self.initNetCDF(self.partfile)
 
-    def initNetCDF(self,fno,fillValue=-1.e+20):
+    def close(self):
+        """ Close the working copy and replace the output with it
+        """
+        self.fp.close()
+        os.rename(self.partfile,self.fno)
+
+    def createNetCDF(self,fno):
+        """ New output with the grid, time and category boundaries
+        """
         today = datetime.today()
         fp = nc.Dataset(fno,'w')
         setattr(fp,'history',"Created by <petteri.uotila@fmi.fi> on %s by %s." % \
@@ -65,76 +165,468 @@ class obsIceThickDistr(Antload):
         outVar[:] = self.hiceb[1:]
         outVar.units = 'm'
         outVar.long_name = 'ice thickness category upper boundaries'
-        outVar = fp.createVariable('sitd','f',('time','ncatice','y','x'),fill_value=fillValue)
+        fp.grid = self.grid
+        fp.freq = self.freq
+        fp.ingested = ''
+        self.region.setNetCDFAttrs(fp)
+        return fp
+
+    def initNetCDF(self,fno,fillValue=-1.e+20,chunk=32):
+        fp = self.createNetCDF(fno)
+        # empty cells are never written and read back masked by fillValue,
+        # chunks hold one time step of all categories of a small tile
+        outVar = fp.createVariable('sitd','f',('time','ncatice','y','x'),\
+                                   fill_value=fillValue,zlib=True,\
+                                   chunksizes=(1,self.ncatice,\
+                                               min(chunk,self.gx),\
+                                               min(chunk,self.gy)))
         outVar.units = " "
         outVar.long_name = 'EM ice thickness count per category'
         outVar.coordinates = "time ncatice nav_lon nav_lat"
         outVar.missing_value = fillValue
         fp.sync()
         self.fp = fp
+        # sparse counts of the open time step: sorted flattened
+        # (cat,x,y) indices and their counts
+        self.cells = np.zeros(0,dtype=np.int64)
+        self.counts = np.zeros(0,dtype=np.int64)
 
-    def sampleEMThickness(self,emo,lastFile=False,yoffset=0):
-        emts = np.array(emo.data)
+    def openNetCDF(self,fno):
+        """ Open an existing output to merge new input files into it
+        """
+        fp = nc.Dataset(fno,'a')
+        if hasattr(fp,'pending'):
+            pending = fp.pending
+            fp.close()
+            raise RuntimeError("Ingestion of %s to %s was interrupted, "\
+                               "recreate the output!" % (pending,fno))
+        if fp.variables['sitd'].shape[1:]!=(self.ncatice,self.gx,self.gy) or \
+           not np.allclose(fp.variables['hiceb'][:],self.hiceb[1:]):
+            fp.close()
+            raise ValueError("%s has different categories or grid!" % fno)
+        self.fp = fp
+        self.cells = np.zeros(0,dtype=np.int64)
+        self.counts = np.zeros(0,dtype=np.int64)
+
+    def getIngested(self):
+        """ Input files already in the output, {file name: md5 checksum}
+        """
+        lines = getattr(self.fp,'ingested','').split('\n')
+        # file names may have spaces, checksums do not
+        return dict([line.rsplit(' ',1) for line in lines if line])
+
+    def beginIngest(self,fn,checksum):
+        self.fp.pending = "%s %s" % (fn,checksum)
+        self.fp.sync()
+
+    def endIngest(self):
+        self.fp.ingested = getattr(self.fp,'ingested','') + self.fp.pending + '\n'
+        self.fp.delncattr('pending')
+        self.fp.sync()
+
+    def timeDays(self):
+        """ Output time steps as datetime64[D]
+        """
+        time = self.fp.variables['time']
+        if time.shape[0]==0:
+            return np.zeros(0,dtype='datetime64[D]')
+        origin = np.datetime64(time.units.split()[2],'D')
+        return origin + time[:].astype(np.int64)
+
+    def readStep(self,it):
+        """ Read time step it to sparse counts of the open time step
+        """
+        with self.instr.timer('readstep'):
+            cnts = np.ma.filled(self.fp.variables['sitd'][it],0).ravel()
+        self.cells = np.flatnonzero(cnts)
+        self.counts = cnts[self.cells].astype(np.int64)
+
+    def insertStep(self,it):
+        """ Insert an empty time step before it by moving later steps
+        """
         time = self.fp.variables['time']
         sitd = self.fp.variables['sitd']
-        FillValue = sitd._FillValue
-        it = time.shape[0]-1
-        if it>=0:
-            date = self.prevdate
-            cnts = sitd[-1]
-        else: # it=-1
-            it = 0
-            date = datetime(emo.dates[0].year + yoffset,\
-                            emo.dates[0].month,emo.dates[0].day)
-            time.units = "days since %04d-%02d-%02d" % \
-                         (date.year,date.month,date.day)
-            cnts = np.zeros((self.ncatice,self.gx,self.gy),dtype='i')
+        for k in range(time.shape[0]-1,it-1,-1):
+            time[k+1] = time[k]
+            sitd[k+1] = sitd[k]
+        sitd[it] = np.ma.masked_all(sitd.shape[1:],dtype='f')
+
+    def toRegion(self,icat,x,y):
+        """ Local grid indices of segments at global indices x,y,
+            segments outside the region get category -1.
+            Segments of invalid thickness are counted apart from those
+            of valid thickness outside the region.
+        """
+        lx, ly, inside = self.region.toLocal(x,y)
+        bad = np.asarray(icat)<0
+        self.instr.count('segments.badthickness',np.sum(bad))
+        self.instr.count('segments.outside',np.sum(~bad&~inside))
+        icat = np.where(inside,icat,-1)
+        return icat, np.where(inside,lx,0), np.where(inside,ly,0)
+
+    def classifyThickness(self,emts):
+        """ 0-based ice thickness category of each thickness in emts,
+            -1 for negative and out of range thicknesses.
+        """
+        emts = np.asarray(emts)
+        icat = np.searchsorted(self.hiceb,emts,side='right')-1
+        icat[(emts<0.)|(icat>=self.ncatice)] = -1
+        return icat
+
+    def addCounts(self,cells):
+        """ Add observations at flattened (cat,x,y) indices cells
+            to the sparse counts of the open time step.
+        """
+        with self.instr.timer('bin'):
+            allcells = np.hstack((self.cells,cells))
+            weights = np.hstack((self.counts,np.ones(len(cells),dtype=np.int64)))
+            self.cells, inv = np.unique(allcells,return_inverse=True)
+            self.counts = np.bincount(inv,weights=weights).astype(np.int64)
+        self.instr.count('segments.binned',len(cells))
+
+    def writeStep(self,it,date):
+        """ Write the open time step, only the bounding box of the
+            touched cells and within it only non-zero counts.
+        """
+        time = self.fp.variables['time']
+        sitd = self.fp.variables['sitd']
+        time[it] = self.cdftime.date2num(date)
+        if len(self.cells):
+            cat, x, y = np.unravel_index(self.cells,\
+                                         (self.ncatice,self.gx,self.gy))
+            x0, y0 = x.min(), y.min()
+            block = np.ma.masked_all((self.ncatice,x.max()-x0+1,y.max()-y0+1),\
+                                     dtype='f')
+            block[cat,x-x0,y-y0] = self.counts
+            with self.instr.timer('writestep'):
+                sitd[it,:,x0:x0+block.shape[1],y0:y0+block.shape[2]] = block
+            self.instr.count('cells.written',len(self.cells))
+            self.instr.count('bytes.written',block.size*block.itemsize)
+        with self.instr.timer('sync'):
+            self.fp.sync()
+        print "Stored timestep=%d, sum(cnt)=%d" % (it,self.counts.sum())
+
+    def sampleEMThickness(self,emo,yoffset=0,icat=None,days=None,x=None,y=None):
+        """ Add EM segments of emo to the time steps of the output,
+            see mergeEMThickness. Categories icat, days with yoffset
+            applied and grid indices x,y can be given when computed once
+            for several outputs.
+        """
+        if icat is None:
+            with self.instr.timer('classify'):
+                icat = self.classifyThickness(emo.data)
+        if days is None:
+            days = shiftYears(np.array(emo.dates,dtype='datetime64[D]'),yoffset)
+        if x is None:
+            x, y = np.asarray(emo.x), np.asarray(emo.y)
+        self.mergeEMThickness(icat,days,x,y)
+
+    def mergeEMThickness(self,icat,days,x,y):
+        """ Merge valid segments to the time steps of their periods,
+            adding new time steps in time order when needed, so input
+            files may overlap or come in any time order. The time of a
+            step is its last segment day.
+        """
+        time = self.fp.variables['time']
+        if time.shape[0]==0:
+            time.units = "days since %s" % days[0]
         self.cdftime = utime(time.units,calendar='standard')
-        prevdate = date
-        for i, emt in enumerate(emts):
-            if emt<0.: continue
-            # monthly temporal resolution
-            date = datetime(emo.dates[i].year+yoffset,\
-                            emo.dates[i].month,emo.dates[i].day)
-            if date.month!=prevdate.month:
-                # store values for previous time step
-                time[it] = self.cdftime.date2num(prevdate)
-                sitd[it] = cnts
-                self.fp.sync()
-                print "Stored timestep=%d, sum(cnt)=%d" % (it,cnts.sum())
-                # new time step
-                it += 1
-                cnts = np.zeros((self.ncatice,self.gx,self.gy),dtype='i')
-            if i%10000==0:
-                print "Processing timestep=%d %s, i=%d" % \
-                      (it,date.strftime("%Y-%m-%d"),i)
-            icat = np.where(emt<self.hiceb)[0][0]
-            cnts[icat-1,emo.x[i],emo.y[i]] += 1
-            prevdate = date
-        # store values if the last file
+        icat, x, y = self.toRegion(icat,x,y)
+        ivalid = np.where(icat>=0)[0]
+        keys = periodKeys(days[ivalid],self.freq)
+        cell = np.ravel_multi_index((icat[ivalid],x[ivalid],y[ivalid]),\
+                                    (self.ncatice,self.gx,self.gy))
+        order = np.argsort(keys,kind='mergesort')
+        ukeys, bnds = np.unique(keys[order],return_index=True)
+        bnds = np.hstack((bnds,len(order)))
+        for k, key in enumerate(ukeys):
+            sel = order[bnds[k]:bnds[k+1]]
+            steps = self.timeDays()
+            stepkeys = periodKeys(steps,self.freq)
+            it = np.searchsorted(stepkeys,key)
+            lastday = days[ivalid[sel]].max()
+            if it<len(stepkeys) and stepkeys[it]==key:
+                self.readStep(it)
+                lastday = max(lastday,steps[it])
+            else:
+                if it<len(stepkeys):
+                    self.insertStep(it)
+                self.cells = np.zeros(0,dtype=np.int64)
+                self.counts = np.zeros(0,dtype=np.int64)
+            self.addCounts(cell[sel])
+            self.writeStep(it,day2datetime(lastday))
+
+class obsThickHistogram(obsIceThickDistr):
+    def __init__(self,fno,grid='orca025',dh=0.05,hmax=10.,freq='1m',\
+                 append=False,region=None,instr=NULL):
+        """ Counts in thickness bins of width dh up to hmax and a last
+            bin from hmax to 99 m, so that rebinHistogram can make
+            outputs of any categories without the segment files.
+            Counts of a time step are stored sparsely as entries of
+            flattened (bin,y,x) cell indices and counts.
+        """
+        nbin = int(round(hmax/dh))
+        hiceb = np.hstack((np.arange(nbin+1)*dh,[99.]))
+        obsIceThickDistr.__init__(self,fno,grid=grid,ncatice=nbin+1,\
+                                  hiceb=hiceb,freq=freq,append=append,\
+                                  region=region,instr=instr)
+
+    def initNetCDF(self,fno):
+        fp = self.createNetCDF(fno)
+        fp.createDimension('entry',None)
+        outVar = fp.createVariable('first','i8',('time',))
+        outVar.long_name = 'first entry of the time step'
+        outVar = fp.createVariable('nentry','i4',('time',))
+        outVar.long_name = 'number of entries of the time step'
+        outVar = fp.createVariable('cell','i8',('entry',),zlib=True)
+        outVar.long_name = 'flattened (ncatice,y,x) index'
+        outVar = fp.createVariable('count','i4',('entry',),zlib=True)
+        outVar.long_name = 'EM ice thickness count'
+        fp.sync()
+        self.fp = fp
+        self.cells = np.zeros(0,dtype=np.int64)
+        self.counts = np.zeros(0,dtype=np.int64)
+
+    def openNetCDF(self,fno):
+        """ Open an existing histogram to merge new input files into it
+        """
+        fp = nc.Dataset(fno,'a')
+        if hasattr(fp,'pending'):
+            pending = fp.pending
+            fp.close()
+            raise RuntimeError("Ingestion of %s to %s was interrupted, "\
+                               "recreate the output!" % (pending,fno))
+        shape = tuple([len(fp.dimensions[d]) for d in ['ncatice','y','x']])
+        if shape!=(self.ncatice,self.gx,self.gy) or \
+           not np.allclose(fp.variables['hiceb'][:],self.hiceb[1:]):
+            fp.close()
+            raise ValueError("%s has different bins or grid!" % fno)
+        self.fp = fp
+        self.cells = np.zeros(0,dtype=np.int64)
+        self.counts = np.zeros(0,dtype=np.int64)
+
+    def readStep(self,it):
+        with self.instr.timer('readstep'):
+            f = int(self.fp.variables['first'][it])
+            n = int(self.fp.variables['nentry'][it])
+            self.cells = np.asarray(self.fp.variables['cell'][f:f+n],\
+                                    dtype=np.int64)
+            self.counts = np.asarray(self.fp.variables['count'][f:f+n],\
+                                     dtype=np.int64)
+
+    def insertStep(self,it):
+        """ Insert an empty time step before it, entries stay in place
+        """
+        nsteps = self.fp.variables['time'].shape[0]
+        for v in ['time','first','nentry']:
+            var = self.fp.variables[v]
+            for k in range(nsteps-1,it-1,-1):
+                var[k+1] = var[k]
+        self.fp.variables['first'][it] = len(self.fp.variables['cell'])
+        self.fp.variables['nentry'][it] = 0
+
+    def writeStep(self,it,date):
+        """ Append entries of the open time step, a rewritten time step
+            whose entries are the last ones overwrites them, others
+            leave their old entries unused
+        """
+        time = self.fp.variables['time']
+        first = self.fp.variables['first']
+        nentry = self.fp.variables['nentry']
+        n = len(self.fp.variables['cell'])
+        if it<time.shape[0] and int(first[it])+int(nentry[it])==n:
+            n = int(first[it])
         time[it] = self.cdftime.date2num(date)
-        sitd[it] = cnts
-        self.fp.sync()
-        print "Stored timestep=%d, sum(cnt)=%d" % (it,cnts.sum())
-        # store the last date in the input file
-        self.prevdate = date
-        if lastFile:
-            sitd[:] = np.ma.masked_equal(sitd[:],0)
+        first[it] = n
+        nentry[it] = len(self.cells)
+        with self.instr.timer('writestep'):
+            if len(self.cells):
+                self.fp.variables['cell'][n:n+len(self.cells)] = self.cells
+                self.fp.variables['count'][n:n+len(self.cells)] = self.counts
+        self.instr.count('cells.written',len(self.cells))
+        with self.instr.timer('sync'):
+            self.fp.sync()
+        print "Stored timestep=%d, sum(cnt)=%d" % (it,self.counts.sum())
 
-if __name__ == "__main__":
-    sit = obsIceThickDistr('antload_1m_sitd.nc')
-    fns = sorted(glob.glob('antload??.cpickle.gz'))
-    #fns = ['mittaus13.mat.cpickle.gz','mittaus14.mat.cpickle.gz']
-    lastFile = False
+def rebinHistogram(fn,hiceb,fno=None):
+    """ Category count output like obsIceThickDistr with category
+        boundaries hiceb (lower and upper) from fine histograms fn of
+        obsThickHistogram. Boundaries are rounded to the nearest bin
+        edges, bins outside them are left out. Default fno is fn
+        with _hist replaced by _sitd. Return the output file name.
+    """
+    if fno is None:
+        fno = fn.replace('_hist','_sitd')
+    fp = nc.Dataset(fn)
+    edges = np.hstack(([0.],fp.variables['hiceb'][:]))
+    ib = np.argmin(np.abs(edges[:,np.newaxis]-\
+                          np.asarray(hiceb,dtype=float)[np.newaxis,:]),axis=0)
+    if np.any(np.diff(ib)<=0):
+        fp.close()
+        raise ValueError("Categories %s are narrower than the bins!" % hiceb)
+    dev = np.abs(edges[ib]-hiceb).max()
+    if dev>1.e-6:
+        print "Category boundaries rounded to bin edges by up to %.3f m" % dev
+    # category of each bin, -1 outside the categories
+    lookup = np.searchsorted(ib,np.arange(len(edges)-1),side='right')-1
+    lookup[lookup>=len(ib)-1] = -1
+    region = Region.fromNetCDF(fp,(len(fp.dimensions['y']),\
+                                   len(fp.dimensions['x'])))
+    sit = obsIceThickDistr(fno,grid=fp.grid,ncatice=len(ib)-1,\
+                           hiceb=edges[ib],freq=fp.freq,region=region)
+    time = fp.variables['time']
+    if time.shape[0]:
+        sit.fp.variables['time'].units = time.units
+        sit.cdftime = utime(time.units,calendar='standard')
+    first, nentry = fp.variables['first'][:], fp.variables['nentry'][:]
+    cell = np.asarray(fp.variables['cell'][:],dtype=np.int64)
+    count = np.asarray(fp.variables['count'][:],dtype=np.int64)
+    for it in range(time.shape[0]):
+        sel = slice(int(first[it]),int(first[it])+int(nentry[it]))
+        b, x, y = np.unravel_index(cell[sel],(len(edges)-1,sit.gx,sit.gy))
+        cat = lookup[b]
+        ok = cat>=0
+        cells = np.ravel_multi_index((cat[ok],x[ok],y[ok]),\
+                                     (sit.ncatice,sit.gx,sit.gy))
+        sit.cells, inv = np.unique(cells,return_inverse=True)
+        sit.counts = np.bincount(inv,weights=count[sel][ok]).astype(np.int64)
+        sit.writeStep(it,sit.cdftime.num2date(time[it]))
+    sit.fp.ingested = fp.ingested
+    sit.close()
+    fp.close()
+    return fno
+
+def trackRegion(fns,grid,pad=1):
+    """ Region of grid covering the tracks in segment files fns
+    """
+    grd = Antload()
+    grd.readModelGrid(grdfile=GRIDFILES[grid])
+    if grid=='orca025':
+        objs = [load_segments(fn,columns=['x','y']) for fn in fns]
+        x = np.hstack([obj.x for obj in objs])
+        y = np.hstack([obj.y for obj in objs])
+    else:
+        objs = [load_segments(fn,columns=['lat','lon']) for fn in fns]
+        x, y = grd.nearestGridIndices(np.hstack([obj.lon for obj in objs]),\
+                                      np.hstack([obj.lat for obj in objs]))
+    return Region.fromIndices(x,y,pad,grd.grdlat.shape)
+
+def sampleFiles(fns,grids=['orca025'],freqs=['1m'],\
+                corrections=DATECORRECTIONS,append=False,roi=None,dh=None,\
+                instr=NULL):
+    """ Sample segment files fns to every grid and frequency in one pass,
+        segments are read and classified once per file.
+        With dh also fine histograms of bin width dh are sampled,
+        see obsThickHistogram.
+        corrections maps file names to date corrections.
+        With append existing outputs are kept and only files not yet
+        ingested are merged to them, so reruns do not change outputs.
+        roi limits outputs to 'track', the observed tracks, or to a
+        (latmin,latmax,lonmin,lonmax) box.
+        Timers and counters of all outputs are added to instr.
+    """
+    regions = dict([(grid,trackRegion(fns,grid) if roi=='track' else roi) \
+                    for grid in grids])
+    sits = dict([((grid,freq,'sitd'),obsIceThickDistr(outputFile(grid,freq),\
+                                               grid=grid,freq=freq,\
+                                               append=append,\
+                                               region=regions[grid],\
+                                               instr=instr)) \
+                 for grid in grids for freq in freqs])
+    kinds = ['sitd']
+    if dh is not None:
+        kinds.append('hist')
+        for grid in grids:
+            for freq in freqs:
+                sits[(grid,freq,'hist')] = \
+                    obsThickHistogram(outputFile(grid,freq,'hist'),\
+                                      grid=grid,dh=dh,freq=freq,\
+                                      append=append,region=regions[grid],\
+                                      instr=instr)
+    columns = ['data','time','x','y']
+    if [grid for grid in grids if grid!='orca025']:
+        columns += ['lat','lon']
     for fn in fns:
-        if fn==fns[-1]:
-            lastFile = True
-        if fn in ['antload17.cpickle.gz']:
-            yoffset = 1 # timestamp has a wrong year (2013 not 2014)
-        else:
-            yoffset = 0
-        print "Reading %s, lastFile=%s and yoffset=%d" % (fn,lastFile,yoffset)
-        obj = load_zipped_pickle(fn)
-        sit.sampleEMThickness(obj,lastFile,yoffset=yoffset)
-    sit.fp.close()
+        with instr.timer('md5'):
+            checksum = md5sum(fn)
+        todo = []
+        for key, sit in sorted(sits.items()):
+            ingested = sit.getIngested()
+            if fn not in ingested:
+                todo.append(key)
+            elif ingested[fn]!=checksum:
+                print "%s has changed since it was ingested to %s, "\
+                      "recreate the output!" % (fn,sit.fno)
+        if not todo:
+            print "Skipping %s, already ingested" % fn
+            continue
+        correction = fileCorrection(corrections,fn)
+        print "Reading %s with date correction %s" % (fn,correction)
+        obj = load_segments(fn,columns=columns,instr=instr)
+        instr.count('segments.read',len(obj.data))
+        days = correctDates(obj.dates,correction).astype('datetime64[D]')
+        icats = {}
+        with instr.timer('classify'):
+            for kind in kinds:
+                sit = sits[(grids[0],freqs[0],kind)]
+                icats[kind] = sit.classifyThickness(obj.data)
+        for grid in grids:
+            if grid=='orca025':
+                x, y = obj.x, obj.y
+            else:
+                with instr.timer('gridlookup'):
+                    x, y = sits[(grid,freqs[0],'sitd')].nearestGridIndices(\
+                                                           obj.lon,obj.lat)
+            for freq in freqs:
+                for kind in kinds:
+                    if (grid,freq,kind) not in todo:
+                        continue
+                    sit = sits[(grid,freq,kind)]
+                    icat = icats[kind]
+                    sit.beginIngest(fn,checksum)
+                    sit.mergeEMThickness(icat,days,x,y)
+                    sit.endIngest()
+    for sit in sits.values():
+        sit.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--grids',nargs='+',default=['orca025'],\
+                        choices=sorted(GRIDFILES.keys()))
+    parser.add_argument('--freqs',nargs='+',default=['1m'],choices=FREQS)
+    parser.add_argument('-a','--append',action='store_true',\
+                        help="merge new input files to existing outputs")
+    parser.add_argument('--roi',nargs='+',default=None,\
+                        help="'track' or latmin latmax lonmin lonmax")
+    parser.add_argument('--dh',type=float,default=None,\
+                        help="also sample fine histograms of bin width DH m")
+    parser.add_argument('--rebin',default=None,metavar='HIST',\
+                        help="only make a category output of fine histograms")
+    parser.add_argument('--hiceb',nargs='+',type=float,default=None,\
+                        help="category boundaries of --rebin, e.g. 0 0.5 1 2 4 99")
+    parser.add_argument('-o','--output',default=None,\
+                        help="output file of --rebin")
+    parser.add_argument('--stats',default=None,metavar='FILE',\
+                        help="write timers and counters to a .json or .csv file")
+    parser.add_argument('--profile',nargs='+',default=[],metavar='STAGE',\
+                        help="profile stages, e.g. bin writestep sync")
+    args = parser.parse_args()
+    if args.rebin is not None:
+        if args.hiceb is None:
+            parser.error("--rebin needs --hiceb")
+        print "Wrote %s" % rebinHistogram(args.rebin,args.hiceb,args.output)
+        sys.exit(0)
+    instr = getInstrument(args.stats is not None,args.profile)
+    roi = args.roi
+    if roi is not None:
+        roi = 'track' if roi==['track'] else tuple([float(r) for r in roi])
+    fns = sorted(glob.glob('antload??.nc'))
+    sampleFiles(fns,grids=args.grids,freqs=args.freqs,\
+                append=args.append,roi=roi,dh=args.dh,instr=instr)
+    if args.stats is not None:
+        instr.report()
+        instr.write(args.stats)
+    else:
+        instr.writeProfiles('sampleEM2ORCA')
     print "Finnished!"